@@ -15,9 +15,16 @@
 
 import os
 import re
+import cProfile
+import resource
+import tracemalloc
+import multiprocessing.util
 import mwparserfromhell
 from mwparserfromhell import nodes
+from mwparserfromhell.smart_list import SmartList
+from mwparserfromhell.wikicode import Wikicode
 from textwrap import indent
+from time import perf_counter
 
 
 #================ CONFIG ====================
@@ -37,6 +44,18 @@ USE_PEDANTIC = True
 
 # 118 is real limit, but use lower since this is performed as a pre-process
 WIDTH = 95
+
+# tables wider than this (in characters) or with more cells are written as a list-table,
+# since huge grid tables are unreadable and slow to parse for Sphinx
+TABLE_MAX_WIDTH = 160
+TABLE_MAX_CELLS = 400
+
+# remember the conversion of this many small links on each page,
+# so repeated ones are converted once, 0 to disable
+MEMO_SIZE = 1024
+# a kind of node with this many misses on a page, and fewer hits, is no longer memoized on it,
+# looking up nodes which don't repeat costs more than converting them
+MEMO_PROBE = 16
 #============================================
 
 EMPTY_STRING = ""
@@ -99,6 +118,13 @@ def wikipath_to_rstpath(path):
     return path[len('2.6/Manual/'):].lower().replace(' ', '_').replace("'", "")
 
 
+def is_blank_param(param):
+    # same as 'param.strip() == ""', without writing out the (possibly deeply nested) value
+    if param.showkey:
+        return False
+    return all(isinstance(n, nodes.text.Text) and not n.value.strip() for n in param.value.nodes)
+
+
 def is_image_file(filename):
     filename = filename.lower().strip()
     if filename.endswith(('.jpg', '.jpeg', '.png', '.gif')):
@@ -106,67 +132,71 @@ def is_image_file(filename):
     return False
 
 
-def wrap_smart(l, width):
+# wrap_smart() breaks after runs of these characters when followed by whitespace...
+WRAP_AFTER = [(c, re.compile(re.escape(c) + r"+\s+")) for c in ",.;:)]"]
+# ...and before links and parentheses
+WRAP_BEFORE = [re.compile(r"(\[\[[^\[]*)"), re.compile(r"(\([^\(]*)")]
+WRAP_WHITESPACE_RE = re.compile(r"(\s)")
+
+
+def wrap_split_after(l, c, r):
     """
-    Visually pleasing wrap, taking punctuation into account.
+    Same fragments as re.split(r"([^c]+c+\s+)", l) without the empty ones,
+    found in linear time (that regex retries each start position of a text without 'c').
     """
-    import re
-
-    # first explode
-    if not hasattr(wrap_smart, "cache"):
-        wrap_smart.cache = cache = []
-        s = [r"([^X]+X+\s+)".replace("X", c) for c in (r"\,", r"\.", ";", ":", r"\)", "\]")]
-        for e in s:
-            r = re.compile(e)
-            wrap_smart.cache.append(r)
-
-        r = re.compile(r"(\[\[[^\[]*)")
-        wrap_smart.cache.append(r)
-
-        r = re.compile(r"(\([^\(]*)")
-        wrap_smart.cache.append(r)
-        del r
-        wrap_smart.cache_ws = cache_ws = re.compile(r"(\s)")
-    else:
-        cache = wrap_smart.cache
-        cache_ws = wrap_smart.cache_ws
+    start = 0
+    for m in r.finditer(l):
+        pos = m.start()
+        if pos == start:
+            # no text before the punctuation
+            continue
+        head = max(start, l.rfind(c, start, pos) + 1)
+        if head != start:
+            yield l[start:head]
+        yield l[head:m.end()]
+        start = m.end()
+    if start != len(l):
+        yield l[start:]
 
 
-    # --------------------
-    # iteratively re-split
-    l = [l]
-
+def wrap_smart(l, width):
+    """
+    Visually pleasing wrap, taking punctuation into account.
+    """
     # -------------------
     # split on delimiters
-    for r in cache:
-        i = len(l)
-        while i > 0:
-            i -= 1
-            l[i : i + 1] = [w for w in re.split(r, l[i]) if w]
+    l = [l]
+    for c, r in WRAP_AFTER:
+        l = [w for s in l for w in wrap_split_after(s, c, r)]
+    for r in WRAP_BEFORE:
+        l = [w for s in l for w in r.split(s) if w]
 
     # -------------------------------------
     # explode all too-long lines into words
-    i = len(l)
-    while i > 0:
-        i -= 1
-        if len(l[i]) > width:
-            l[i : i + 1] = re.split(cache_ws, l[i])
+    l = [w for s in l for w in (WRAP_WHITESPACE_RE.split(s) if len(s) > width else (s,))]
+    if not l:
+        return l
 
     # ------------------------
     # now merge based on width
-    i = 0
-    while i < len(l) - 1:
-        if len(l[i].lstrip()) + len(l[i + 1].rstrip()) < width:
-            l[i : i + 2] = [l[i] + l[i + 1]]
+    lines = []
+    line = l[0]
+    for w in l[1:]:
+        if len(line.lstrip()) + len(w.rstrip()) < width:
+            line += w
         else:
-            l[i] = l[i].strip()
-            i += 1
+            lines.append(line.strip())
+            line = w
+    lines.append(line)
 
-    return l
+    return lines
 
 
-from collections import defaultdict
+from collections import Counter
 # a record type used to collect information during MediaWiki AST traversal
+#
+# only counts are kept, along with a few (truncated) example nodes for each count,
+# so reports stay small enough to send back from worker processes and can be combined with merge()
 
 
 class ConversionReport:
@@ -185,47 +215,152 @@ class ConversionReport:
         "fixme",
         "deleted",
         "images",
+
+        "memo_hits",
+        "memo_misses",
+
+        "samples",
+        "log",
         )
 
+    # plain counts
+    _fields_total = (
+        "arguments",
+        "comments",
+        "external_links",
+        "headings",
+        "texts",
+    )
+    # counts for each key (entity, tag, template name, reason ...)
+    _fields_keyed = (
+        "html_entities",
+        "html_tags",
+        "templates",
+        "wikilinks",
+        "fixme",
+        "deleted",
+        "memo_hits",
+        "memo_misses",
+    )
+    # values in the order they were added
+    _fields_listed = (
+        "images",
+    )
+
+    # number of (distinct) example nodes to keep for each count
+    SAMPLE_LIMIT = 3
+    # only this many of the first nodes for each count are considered as examples
+    SAMPLE_CANDIDATES = 10
+    # example nodes are truncated to this many characters
+    SAMPLE_LENGTH = 200
+
     def __init__(self):
-        self.arguments = []
-        self.comments = []
-        self.external_links = []
-        self.headings = []
-        self.texts = []
-
-        self.html_entities = defaultdict(list)
-        self.html_tags = defaultdict(list)
-        self.templates = defaultdict(list)
-        self.wikilinks = defaultdict(list)
-
-        self.fixme = defaultdict(list)
-        self.deleted = defaultdict(list)
+        self.arguments = 0
+        self.comments = 0
+        self.external_links = 0
+        self.headings = 0
+        self.texts = 0
+
+        self.html_entities = Counter()
+        self.html_tags = Counter()
+        self.templates = Counter()
+        self.wikilinks = Counter()
+
+        self.fixme = Counter()
+        self.deleted = Counter()
+        # (target, width, height) of every embedded image, the size is None when not given
         self.images = []
 
-
-# preprocessing step for MediaWiki code
-def preprocess(mw):
+        # memoized conversions (node type -> count), see ConversionContext.convert()
+        self.memo_hits = Counter()
+        self.memo_misses = Counter()
+
+        # (field, key) -> list of example nodes (as strings)
+        self.samples = {}
+
+        # when a list, add() calls are recorded as (field, node, key) so they can be replayed
+        self.log = None
+
+    def add(self, field, node, key=None):
+        if self.log is not None:
+            self.log.append((field, node, key))
+        if key is None:
+            count = getattr(self, field) + 1
+            setattr(self, field, count)
+        elif field in self._fields_listed:
+            getattr(self, field).append(key)
+            return
+        else:
+            counter = getattr(self, field)
+            count = counter[key] = counter[key] + 1
+        if count > self.SAMPLE_CANDIDATES:
+            return
+        samples = self.samples.get((field, key))
+        if samples is None:
+            self.samples[field, key] = samples = []
+        if len(samples) < self.SAMPLE_LIMIT:
+            try:
+                sample = str(node)[:self.SAMPLE_LENGTH]
+            except RecursionError:
+                # too deeply nested for mwparserfromhell to write out, skip it
+                return
+            if sample not in samples:
+                samples.append(sample)
+
+    def merge(self, other):
+        """
+        Add the counts from another report into this one, returns self.
+        """
+        for field in self._fields_total:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        for field in self._fields_keyed:
+            getattr(self, field).update(getattr(other, field))
+        self.images.extend(other.images)
+        for field_key, samples_other in other.samples.items():
+            samples = self.samples.get(field_key)
+            if samples is None:
+                self.samples[field_key] = samples = []
+            for sample in samples_other:
+                if len(samples) == self.SAMPLE_LIMIT:
+                    break
+                if sample not in samples:
+                    samples.append(sample)
+        return self
+
+
+# plain text replacements done by preprocess(), in order
+PREPROCESS_REPLACEMENTS = (
     # escape the backtick
-    mw = mw.replace('`', '\`')
+    ('`', '\\`'),
 
     # fancier arrows
-    mw = mw.replace('-&gt;', RIGHT_ARROW)
+    ('-&gt;', RIGHT_ARROW),
 
-    mw = mw.replace("\u201C", '"')
-    mw = mw.replace("\u201D", '"')
+    ("\u201C", '"'),
+    ("\u201D", '"'),
 
-    mw = mw.replace("\u2018", "'")
-    mw = mw.replace("\u2019", "'")
-    mw = mw.replace("\u8211", "-")
-    mw = mw.replace("\u2013", "-")
+    ("\u2018", "'"),
+    ("\u2019", "'"),
+    ("\u8211", "-"),
+    ("\u2013", "-"),
 
     # get rid of __TOC__
-    mw = mw.replace('__TOC__', EMPTY_STRING)
+    ('__TOC__', EMPTY_STRING),
 
     # remove left-to-right mark: '‎' (it's between the quotes, but it's an invisible char!)
     # this occurs at the end of several image/file links for some reason
-    mw = mw.replace('\u200e', EMPTY_STRING)
+    ('\u200e', EMPTY_STRING),
+)
+TABLE_END_RE = re.compile(r'\|\}(?!\})')
+# '{|' not preceded by '{', with the lookbehind after the '{' so the search can skip ahead to it
+TABLE_START_RE = re.compile(r'\{(?<!\{\{)\|')
+DEFINITION_RE = re.compile(r'^(:*)?;(.*)')
+
+
+# preprocessing step for MediaWiki code
+def preprocess(mw):
+    for old, new in PREPROCESS_REPLACEMENTS:
+        mw = mw.replace(old, new)
 
     # Table syntax like this is not supported by mwparserfromhell
     #
@@ -235,24 +370,12 @@ def preprocess(mw):
     #
     #   {{Table|align=left|...content ...|}}
     #
-    mw = re.sub(r'(?<!\{)\{\|', '{{Table|', re.sub(r'\|\}(?!\})', '}}', mw))
+    mw = TABLE_START_RE.sub('{{Table|', TABLE_END_RE.sub('}}', mw))
     # using ! instead of | in tables (for bolded markup) is not supported
     # changed to a mock row argument instead
     # TODO actually support parsing this
     #mw = mw.replace('\n! ', '\n| special="bold"')
 
-    def replace_header(line):
-        line = line.strip()
-        if line.startswith('!'):
-            return '| special="bold"|' + line[1:].replace("!!", '||')
-        else:
-            return line
-    mw = '\n'.join([replace_header(line) for line in mw.split('\n')])
-
-    # table header syntax (rows starting with '+')
-    # TODO actually support parsing this
-    mw = mw.replace('\n|+', '\n| special="head"|')
-
     # indent definition lists of the format:
     #
     # ;term
@@ -274,29 +397,54 @@ def preprocess(mw):
         if tail != EMPTY_STRING:
             res.append('\n' + ((indents + 1) * ':') + tail.strip())
         return ''.join(res)
-    mw = '\n'.join(re.sub(r'^(:*)?;(.*)', replace_def, s)
-                   for s in mw.split('\n'))
 
     # wrap long lines (body text only for now)
-    if USE_PEDANTIC:
-        mw = mw.split("\n")
-        i = len(mw) - 1
-        while i >= 0:
-            # simple cleanup
-            mw[i] = mw[i].rstrip()
+    # 118 is real limit, but RST may expand a bit
+    def append_line(line):
+        if USE_PEDANTIC and len(line) > WIDTH and line[0].isalnum() and "[[" not in line:
+            mw_lines.extend(wrap_smart(line, WIDTH))
+        else:
+            mw_lines.append(line)
 
-            # 118 is real limit, but RST may expand a bit
-            if len(mw[i]) > WIDTH and mw[i][0].isalnum():
-                ok = True
-                if "[[" in mw[i]:
-                    ok = False
-                if ok:
-                    mw[i:i + 1] = wrap_smart(mw[i], WIDTH)
-            i -= 1
-        mw = '\n'.join(mw)
+    # all line based rules are applied in a single pass
+    mw_lines = []
+    for i, line in enumerate(mw.split('\n')):
+        line = line.strip()
+        if line.startswith('!'):
+            line = '| special="bold"|' + line[1:].replace("!!", '||')
+        elif i != 0 and line.startswith('|+'):
+            # table header syntax (rows starting with '+')
+            # TODO actually support parsing this
+            line = '| special="head"|' + line[2:]
+        elif ';' in line:
+            m = DEFINITION_RE.match(line)
+            if m is not None:
+                for line in replace_def(m).split('\n'):
+                    append_line(line)
+                continue
+        append_line(line)
+
+    return '\n'.join(mw_lines)
+
+
+# control token patterns used by postprocess(), see remarkup()
+#
+# markup that ends up with no content
+MARKUP_EMPTY_RE = re.compile("|".join(re.escape(l + r) for l, r in ALL_MARKUP))
+# whitespace at the end/start of markup
+# (only match from the start of the whitespace, so long runs of it aren't scanned over and over)
+MARKUP_SPACE_RIGHT_RE = re.compile(r"(?<!\s)(\s+)(%s)" % "|".join(dict.fromkeys(re.escape(r) for l, r in ALL_MARKUP)))
+MARKUP_SPACE_LEFT_RE = re.compile(r"(%s)(\s+)" % "|".join(dict.fromkeys(re.escape(l) for l, r in ALL_MARKUP)))
+# '├' followed by, or '┤' preceded by a non-whitespace character
+# (a '┤' directly after another control token already has an escaped space in front of it)
+MARKUP_ESCAPE_SPACE_RE = re.compile(r"├(?=\S)|(?<=[^\s├┤])┤")
+MARKUP_TOKENS_STRIP = str.maketrans("", "", "├┤")
+BULLET_RE = re.compile("°+")
+NEWLINES_RE = re.compile("\n{4,}")
 
 
-    return mw
+def replace_bp(m):
+    return "%s- " % ((len(m.group(0)) - 1) * '  ')
 
 
 # postprocessing step after AST-to-RST conversion
@@ -305,93 +453,65 @@ def preprocess(mw):
 # account for peculiarities in the RST syntax
 def postprocess(rst):
     # remove all markup that ends up with no content, see remarkup()
-    for l, r in ALL_MARKUP:
-        rst = rst.replace(l + r, EMPTY_STRING)
+    rst = MARKUP_EMPTY_RE.sub(EMPTY_STRING, rst)
 
     # markup like this fails in RST, no spaces are allowed:
     # *  markup *
     # therefore, swap the whitespace around with the markup
     #   *markup*
-    def replace_swap(m):
-        return '%s%s' % (m.group(2), m.group(1))
-    for l, r in ALL_MARKUP:
-        rst = re.sub(r'(\s+)(%s)' % re.escape(r), replace_swap, rst)
-        rst = re.sub(r'(%s)(\s+)' % re.escape(l), replace_swap, rst)
-
-    #---------------------------------------------------------
-    # ° - bullet points
-    #---------------------------------------------------------
-    # ensure that there is a blank line in front of every bullet point list
-    rst_lines = rst.split('\n')
-    i = 1
-    i_prev_bullet = False
-    while i < len(rst_lines):
-        if '°' in rst_lines[i]:
-            if '°' not in rst_lines[i - 1]:
-                rst_lines[i] = '\n' + rst_lines[i]
-            i_prev_bullet = True
-        else:
-            # ensure newline after bullets
-            if i_prev_bullet:
-                if rst_lines[i] and not rst_lines[i].isspace():
-                    rst_lines.insert(i, "")
-            i_prev_bullet = False
-        i += 1
-    rst = '\n'.join(rst_lines)
-    del i_prev_bullet
-    # replace bullet point token with appropriate indentation and single bullet
-
-    def replace_bp(m):
-        return "%s- " % ((len(m.group(0)) // len('°') - 1) * '  ')
-    rst = re.sub('(°)+', replace_bp, rst)
-
-    # XXX, removing double spaces after isnt so trivial!
-    # infact this is needed for RST pedantic indentation rules
-    rst = rst.replace("-  ", "- ")
-
-    #--------------------------------------------------------
-    # ┴ - at least one preceeding blank line is required
-    #--------------------------------------------------------
-    rst_lines = list(rst.split('\n'))
-    i = 1
-    while i < len(rst_lines):
-        if '┴' in rst_lines[i]:
-            if rst_lines[i - 1] != EMPTY_STRING:
-                rst_lines[i] = '\n' + rst_lines[i].replace('┴', EMPTY_STRING)
+    rst = MARKUP_SPACE_RIGHT_RE.sub(r"\2\1", rst)
+    rst = MARKUP_SPACE_LEFT_RE.sub(r"\2\1", rst)
+
+    # line based rules, done in a single pass building a new list of lines
+    if '°' in rst or '┴' in rst or "-  " in rst:
+        rst_lines = rst.split('\n')
+        # the first line is only used as the line before a bullet point or '┴'
+        line_prev = rst_lines[0]
+        line_prev_new = BULLET_RE.sub(replace_bp, line_prev).replace("-  ", "- ")
+        rst_lines_new = [line_prev_new]
+        bullet_prev = False
+        for line in rst_lines[1:]:
+            #---------------------------------------------------------
+            # ° - bullet points
+            #---------------------------------------------------------
+            if '°' in line:
+                # ensure that there is a blank line in front of every bullet point list
+                if '°' not in line_prev:
+                    rst_lines_new.append(EMPTY_STRING)
+                    line_prev_new = EMPTY_STRING
+                bullet_prev = True
+                line_prev = line
+                # replace bullet point token with appropriate indentation and single bullet
+                line = BULLET_RE.sub(replace_bp, line)
             else:
-                rst_lines[i] = rst_lines[i].replace('┴', EMPTY_STRING)
-        i += 1
-    rst = '\n'.join(rst_lines)
+                # ensure newline after bullets
+                if bullet_prev and line and not line.isspace():
+                    rst_lines_new.append(EMPTY_STRING)
+                    line_prev_new = EMPTY_STRING
+                bullet_prev = False
+                line_prev = line
+
+            # XXX, removing double spaces after isnt so trivial!
+            # infact this is needed for RST pedantic indentation rules
+            line = line.replace("-  ", "- ")
+
+            #--------------------------------------------------------
+            # ┴ - at least one preceeding blank line is required
+            #--------------------------------------------------------
+            if '┴' in line:
+                if line_prev_new != EMPTY_STRING:
+                    rst_lines_new.append(EMPTY_STRING)
+                line = line.replace('┴', EMPTY_STRING)
+
+            rst_lines_new.append(line)
+            line_prev_new = line
+        rst = '\n'.join(rst_lines_new)
 
     #--------------------------------------------------------
     # ├ - insert escaped space if next character is ???
-    #--------------------------------------------------------
-    def replace_sr(m):
-        next_char = m.group(1)
-        if next_char is not None:
-            # if re.match(r'[a-zA-Z`\*→]', next_char):
-            if re.match(r'\S', next_char):
-                return r'\ ' + next_char
-            else:
-                return next_char
-        else:
-            return EMPTY_STRING
-    rst = re.sub('├(.)?', replace_sr, rst)
-
-    #--------------------------------------------------------
     # ┤ - insert escaped space if previous char is ???
     #--------------------------------------------------------
-    def replace_sl(m):
-        prev_char = m.group(1)
-        if prev_char is not None:
-            # if re.match(r'[a-zA-Z`\*]', prev_char):
-            if re.match(r'\S', prev_char):
-                return prev_char + r'\ '
-            else:
-                return prev_char
-        else:
-            return EMPTY_STRING
-    rst = re.sub('(.)?┤', replace_sl, rst)
+    rst = MARKUP_ESCAPE_SPACE_RE.sub(r"\\ ", rst).translate(MARKUP_TOKENS_STRIP)
 
     # prevent hoz rule being confused with title
     rst = rst.replace("\n----\n", "\n\n----\n\n")
@@ -404,18 +524,26 @@ def postprocess(rst):
 
     if USE_PEDANTIC:
         # double-newlines only
-        len_curr = len(rst)
-        len_prev = -1
-        while len_curr != len_prev:
-            rst = rst.replace("\n\n\n\n", "\n\n\n")
-            len_prev = len_curr
-            len_curr = len(rst)
+        rst = NEWLINES_RE.sub("\n\n\n", rst)
 
     return rst
 
 
+# anything postprocess() would change, see postprocess_cell()
+POSTPROCESS_TRIGGER_RE = re.compile("[┤├┴°\t]|-  |\n----\n|\n\n\n\n")
+
+
+# postprocess() for a single table cell,
+# most cells are plain text and are returned as they are
+def postprocess_cell(content):
+    if POSTPROCESS_TRIGGER_RE.search(content) is None:
+        return content
+    return postprocess(content)
+
+
 # creates a string with a 'painted' RST table
 # takes a list of rows, each item being a list of column items
+# big tables are written as a list-table instead, see TABLE_MAX_WIDTH and TABLE_MAX_CELLS
 def rst_paint_table(table):
     col_count = max(len(row) for row in table)
     # split up items into a list of lines
@@ -424,11 +552,15 @@ def rst_paint_table(table):
     for x, row in enumerate(table):
         for y, content in enumerate(row):
             # postprocess now so that layout does not get messed up later
-            content_split = postprocess(content).split('\n')
+            content_split = postprocess_cell(content).split('\n')
             for line in content_split:
                 col_widths[y] = max(col_widths[y], len(line))
             row[y] = content_split
 
+    total_width = sum(col_widths) + col_count - 1
+    if total_width + 2 > TABLE_MAX_WIDTH or sum(len(row) for row in table) > TABLE_MAX_CELLS:
+        return rst_list_table(table, col_count)
+
     # find the minimum height (number of lines) of each row
     # pad with empty lines for equal heights
     row_heights = [1] * len(table)
@@ -439,7 +571,6 @@ def rst_paint_table(table):
             content_split += [EMPTY_STRING] * \
                 (row_heights[x] - len(content_split))
 
-    total_width = sum(col_widths) + col_count - 1
     border_line = '+%s+' % ('+'.join('-' * width for width in col_widths))
 
     # pad content to proper width, write final lines
@@ -455,6 +586,19 @@ def rst_paint_table(table):
     return '\n'.join(lines)
 
 
+# list-table version of rst_paint_table(), takes rows of already split up cell lines
+# rows are padded with empty cells, a list-table needs the same number of columns in each row
+def rst_list_table(table, col_count):
+    body = []
+    for row in table:
+        row = row + [[EMPTY_STRING]] * (col_count - len(row))
+        for y, content_split in enumerate(row):
+            bullet = '* -' if y == 0 else '  -'
+            body.append(('%s %s' % (bullet, content_split[0])).rstrip())
+            body.extend(('    ' + line).rstrip() for line in content_split[1:])
+    return rst_directive("list-table", None, body).strip('\n')
+
+
 def rst_admonition(class_, title, body, options=None):
     header = "\n.. admonition:: %s\n\t:class: %s\n" % (title, class_)
     return "%s\n%s\n\n" % (header, indent('\n'.join(body), INDENTATION))
@@ -484,449 +628,1089 @@ def remarkup(content, current_markup, previous):
         return ''.join((l, content, r))
 
 
-# convert a mwparserfromhell MediaWiki AST to a string
-# returns a tuple with the (already postprocessed) RST string and the ConversionReport
-# a ConversionReport may optionally be passed to gather information across
-# multiple invocations
-def convert_mw(start_node, report=None):
-    if report is None:
-        report = ConversionReport()
+# like remarkup(), for handlers returning a list of parts (see ConversionContext.convert())
+def remarkup_parts(content_parts, current_markup, previous):
+    l, r = current_markup
+    if previous is not None:
+        pl, pr = previous
+        return [pr, l, *content_parts, r, pl]
+    else:
+        return [l, *content_parts, r]
+
 
-    # convenience functions to return from convert() with
-    def FIXME(node, reason="Undefined"):
-        report.fixme[reason].append(node)
-        print("FIXME(%s)" % (reason))
+# Node conversion is dispatched on the type of the AST node,
+# templates and HTML tags are further dispatched on their (normalized) name.
+#
+# New node types, templates and tags are supported by registering a handler:
+#
+#   @template_handler('name', 'other name')
+#   def template_name(ctx, node, name, strip, markup):
+#       return ...
+#
+# see ConversionContext for the arguments.
+#
+# Handlers return a string, handlers which need their child nodes converted
+# are generators instead, yielding (node, strip, markup) and receiving the converted string:
+#
+#   text = yield node.params[0], strip, markup
+#   return text.strip()
+#
+# Handlers which only surround their child nodes with text return a list of parts instead,
+# each part being a string or (node, strip, markup), see remarkup_parts().
+# These are written straight to the output, without building a string for the child nodes.
+#
+# This lets ConversionContext.convert() walk the AST without recursion.
+#
+# Node handlers registered with memo=True only depend on the node, strip and markup,
+# their result is reused for repeated (small) nodes, see memo_key() and MEMO_PROBE.
+# Templates aren't memoized, building a key costs as much as converting them.
+# Handlers use ctx.report and ctx.message() for all side effects, so these can be replayed.
+
+# node type -> handler(ctx, node, strip, markup)
+NODE_HANDLERS = {}
+# node type -> function returning the child nodes,
+# for nodes which are converted to their children joined together
+NODE_CHILDREN = {
+    mwparserfromhell.wikicode.Wikicode: lambda node: node.nodes,
+    mwparserfromhell.nodes.extras.Parameter: lambda node: (node.value,),
+}
+# template name (stripped, lower case) -> handler(ctx, node, name, strip, markup)
+TEMPLATE_HANDLERS = {}
+# tag name -> handler(ctx, node, strip, markup)
+TAG_HANDLERS = {}
+# node types with memoized conversions
+MEMO_TYPES = set()
+# nodes (counting all nested nodes) larger than this are not memoized
+MEMO_NODE_LIMIT = 64
+
+HTML_ENTITY_TO_TEXT = {
+    'nbsp': '\u00A0',
+    'lt': '<',
+    'gt': '>',
+    'ndash': '–',
+    'mdash': '\u2014',
+    'rarr': RIGHT_ARROW,
+    'amp': '&',
+}
+
+
+def node_handler(*types, memo=False):
+    def register(fn):
+        for t in types:
+            NODE_HANDLERS[t] = fn
+            if memo:
+                MEMO_TYPES.add(t)
+        return fn
+    return register
+
+
+def template_handler(*names):
+    def register(fn):
+        for name in names:
+            TEMPLATE_HANDLERS[name] = fn
+        return fn
+    return register
+
+
+def tag_handler(*names):
+    def register(fn):
+        for name in names:
+            TAG_HANDLERS[name] = fn
+        return fn
+    return register
+
+
+# key for the memoized conversion of a node, None if it's not memoized
+# the first item names the kind of node, for the hit rates in the report
+def memo_key(node, strip, markup, skip=()):
+    kind = node.__class__.__name__.lower()
+    if kind in skip:
+        return None
+    # only small nodes, large ones are unlikely to repeat (and expensive to write out as a key)
+    budget = MEMO_NODE_LIMIT
+    todo = [node]
+    while todo:
+        budget -= 1
+        if budget < 0:
+            return None
+        for child in todo.pop().__children__():
+            todo.extend(child.nodes)
+    return kind, str(node), strip, markup
+
+
+class ConversionContext:
+    """
+    State passed to every handler while converting an AST, see convert_mw().
+    """
+    __slots__ = (
+        "report",
+        "memo",
+        "memo_skip",
+        "messages",
+        )
+
+    def __init__(self, report):
+        self.report = report
+        # (node text, strip, markup) -> (result, report log, messages), see convert()
+        self.memo = {} if MEMO_SIZE else None
+        # kinds of nodes which don't repeat on the page, see MEMO_PROBE
+        self.memo_skip = set()
+        # printed messages, recorded while converting a node to be memoized
+        self.messages = None
+
+    def message(self, text):
+        print(text)
+        if self.messages is not None:
+            self.messages.append(text)
+
+    # convenience functions to return from handlers with
+    def fixme(self, node, reason="Undefined"):
+        self.report.add('fixme', node, reason)
+        self.message("FIXME(%s)" % (reason))
         return "\nFIXME(%s;\n%s\n)" % (reason, node)
 
-    def DELETE(node, reason="Undefined"):
-        report.deleted[reason].append(node)
+    def delete(self, node, reason="Undefined"):
+        self.report.add('deleted', node, reason)
         return EMPTY_STRING
 
-    def COMMENT(node, text):
+    def comment(self, node, text):
         conv = ".. %s ." % (indent(text, INDENTATION))
-        report.comments.append(node)
+        self.report.add('comments', node)
         return conv
 
-    # convert() is the main recursive function to walk the MediaWiki AST
+    # convert() is the main function to walk the MediaWiki AST
     # returns strings, always
     #
     # strip: if True, no further markup is allowed
     # markup: the current markup (or None), see usage of remarkup()
-    def convert(node, strip, markup):
-        # only ast nodes allowed!
-        if node is None:
-            raise ValueError()
-        if isinstance(node, str):
-            raise ValueError()
-
-        # ast nodes parsing starts here
-        elif isinstance(node, nodes.text.Text):
-            report.texts.append(node)
-            # replace arrows here, after HTML stuff has been parsed
-            # not really a good idea, probably will cause conflicts
-            return "%s" % node.value.replace('->', RIGHT_ARROW)
-
-        if isinstance(node, mwparserfromhell.wikicode.Wikicode):
-            return "".join(convert(n, strip, markup) for n in node.nodes)
-
-        if isinstance(node, mwparserfromhell.nodes.extras.Parameter):
-            return convert(node.value, strip, markup)
-
-        # not supported, only used once in the manual
-        if isinstance(node, nodes.argument.Argument):
-            report.arguments.append(node)
-
-        elif isinstance(node, nodes.comment.Comment):
-            return COMMENT(node, "Comment: %s" % (node))
-
-        elif isinstance(node, nodes.external_link.ExternalLink):
-            report.external_links.append(node)
-            if node.title:
-                return remarkup('%s <%s>' % (convert(node.title, True, markup), convert(node.url, True, markup)), M_EXTLINK, markup)
-            else:
-                return convert(node.url, strip, markup)
-
-        elif isinstance(node, nodes.heading.Heading):
-            report.headings.append(node)
-            title = node.title.strip()
-            return "\n%s\n%s\n" % (title, TITLE_CHARS[node.level] * len(title))
-
-        #--------------------------------------------------------
-        #   HTML Entities (&gt; &nbsp; ...)
-        #--------------------------------------------------------
-        elif isinstance(node, nodes.html_entity.HTMLEntity):
-            report.html_entities[node.value].append(node)
-
-            if node.value == 'nbsp':
-                return '\u00A0'
-            if node.value == 'lt':
-                return '<'
-            elif node.value == 'gt':
-                return '>'
-            elif node.value == 'ndash':
-                return '–'
-            elif node.value == 'mdash':
-                return '\u2014'
-            if node.value == 'rarr':
-                return RIGHT_ARROW
-            elif node.value == 'amp':
-                return '&'
-            else:
-                return FIXME(node, 'HTML Entity Unsupported %s' % node.value)
-
-        #--------------------------------------------------------
-        #   HTML Tags (<tag>contents</tag>)
-        #--------------------------------------------------------
-        elif isinstance(node, nodes.tag.Tag):
-            report.html_tags[str(node.tag)].append(node)
-            if str(node.tag) in TAG_TO_MARKUP:
-                if strip:
-                    return convert(node.contents, True, markup)
+    def convert(self, node, strip, markup):
+        # The AST is walked depth first using an explicit stack, holding either
+        # nodes to convert: (node_iter, strip, markup),
+        # parts returned by a handler: (part_iter,)
+        # a handler waiting on a child node: (handler_iter, out_parent)
+        # or a node converted on its own to be memoized: (key, out_parent, log_start, messages_start).
+        #
+        # Converted text is appended to 'out', only the children requested by a handler
+        # are collected into a separate buffer (so they can be passed to the handler as a string).
+        node_children_get = NODE_CHILDREN.get
+        node_handlers_get = NODE_HANDLERS.get
+        memo = self.memo
+        memo_types = MEMO_TYPES if memo is not None else ()
+        memo_skip = self.memo_skip
+        # the node being memoized, skips the lookup when it's converted
+        memo_node = None
+        report = self.report
+        if memo is not None:
+            # side effects are only recorded while a node to be memoized is converted
+            log = []
+            messages = []
+            memo_depth = 0
+        out = []
+        out_push = out.append
+        stack = [(iter((node,)), strip, markup)]
+        while stack:
+            item = stack[-1]
+            if len(item) == 3:
+                node_iter, strip, markup = item
+                handler_iter = None
+                key = None
+                for node in node_iter:
+                    node_children = node_children_get(node.__class__)
+                    if node_children is not None:
+                        break
+                    if node.__class__ in memo_types and node is not memo_node:
+                        key = memo_key(node, strip, markup, memo_skip)
+                        if key is not None:
+                            entry = memo.get(key)
+                            if entry is None:
+                                break
+                            # replay the side effects of the conversion
+                            result, entry_log, entry_messages = entry
+                            for field, node_logged, field_key in entry_log:
+                                report.add(field, node_logged, field_key)
+                            for text in entry_messages:
+                                self.message(text)
+                            report.memo_hits[key[0]] += 1
+                            out_push(result)
+                            key = None
+                            continue
+                    result = node_handlers_get(node.__class__, convert_unsupported)(self, node, strip, markup)
+                    if result.__class__ is str:
+                        out_push(result)
+                    elif result.__class__ is list:
+                        break
+                    else:
+                        handler_iter = result
+                        result = None
+                        break
                 else:
-                    next_markup = TAG_TO_MARKUP[str(node.tag)]
-                    return remarkup(convert(node.contents, strip, next_markup), next_markup, markup)
-            if node.tag == 'dt':  # also matches ;
-                # TODO
-                # probably not necessary to deal with, <dt> is unused in the
-                # wiki
-                return EMPTY_STRING
-            if node.tag == 'dd':  # also matches :
-                if str(node) == ':':
-                    return INDENTATION
-                else:  # <dd>item</dd> - unused in the wiki
-                    return '%s' % indent(convert(node.contents, strip, markup), INDENTATION)
-            elif node.tag == 'br':
-                return '\n'
-            elif node.tag == 'hr':  # also matches ----
-                return '┴----┴'
-            elif node.tag == 'p':
-                #<p>...</p> is ignored
-                return convert(node.contents, strip, markup)
-            elif node.tag == 'center':
-                # rst does not support text alignment?
-                return convert(node.contents, strip, markup)
-            elif node.tag == 'gallery':
-                # TODO <gallery> has additional options
-                # width and height could be supported (but only occurs three times in the manual)
-                # caption could be supported (but only occurs once)
-                gallery_images = []
-                for link in node.contents.strip().split('\n'):
-                    gallery_images.append(
-                        mwparserfromhell.parse('[[%s]]' % link.strip()))
-                return '\n'.join(convert(img, True, markup) for img in gallery_images)
-
-            elif node.tag == 'li':  # also matches # and *
-                if node.contents is not None:
-                    return FIXME(node, 'HTML lists not supported')
+                    stack.pop()
+                    continue
+                if key is not None:
+                    # convert the node into its own buffer, recording its side effects
+                    if not memo_depth:
+                        report.log = log
+                        self.messages = messages
+                    memo_depth += 1
+                    stack.append((key, out, len(log), len(messages)))
+                    stack.append((iter((node,)), strip, markup))
+                    memo_node = node
+                    out = []
+                    out_push = out.append
+                    continue
+                if handler_iter is None:
+                    # the remaining nodes are converted after the children (or parts)
+                    if node_children is not None:
+                        stack.append((iter(node_children(node)), strip, markup))
+                    else:
+                        stack.append((iter(result),))
+                    continue
+            elif len(item) == 1:
+                for part in item[0]:
+                    if part.__class__ is str:
+                        out_push(part)
+                    else:
+                        node, strip, markup = part
+                        stack.append((iter((node,)), strip, markup))
+                        break
                 else:
-                    return "°"
+                    stack.pop()
+                continue
+            elif len(item) == 4:
+                # a memoized node is done
+                stack.pop()
+                key, out_parent, log_start, messages_start = item
+                result = "".join(out)
+                out = out_parent
+                out_push = out.append
+                out_push(result)
+                if len(memo) >= MEMO_SIZE:
+                    # forget the oldest
+                    del memo[next(iter(memo))]
+                memo[key] = result, log[log_start:], messages[messages_start:]
+                memo_depth -= 1
+                if not memo_depth:
+                    report.log = self.messages = None
+                    log.clear()
+                    messages.clear()
+                kind = key[0]
+                misses = report.memo_misses[kind] = report.memo_misses[kind] + 1
+                if misses >= MEMO_PROBE and report.memo_hits[kind] < misses:
+                    memo_skip.add(kind)
+                continue
+            else:
+                # a handler's child node is done, resume the handler with the result
+                stack.pop()
+                handler_iter, out_parent = item
+                result = "".join(out)
+                out = out_parent
+                out_push = out.append
+
+            try:
+                node, strip, markup = handler_iter.send(result)
+            except StopIteration as ex:
+                out_push(ex.value)
+                continue
+            stack.append((handler_iter, out))
+            stack.append((iter((node,)), strip, markup))
+            out = []
+            out_push = out.append
+
+        report.log = None
+        return "".join(out)
+
+
+def convert_unsupported(ctx, node, strip, markup):
+    return ctx.fixme(node, "Type Unsupported: %s" % type(node).__name__)
+
 
-            elif str(node.tag) in {'source', 'pre'}:
-                return '::\n┴%s\n\n' % indent(convert(node.contents, strip, markup), INDENTATION)
+# only ast nodes allowed!
+@node_handler(type(None), str)
+def convert_invalid(ctx, node, strip, markup):
+    raise ValueError()
+
+
+@node_handler(nodes.text.Text)
+def convert_text(ctx, node, strip, markup):
+    ctx.report.add('texts', node)
+    # replace arrows here, after HTML stuff has been parsed
+    # not really a good idea, probably will cause conflicts
+    return "%s" % node.value.replace('->', RIGHT_ARROW)
+
+
+# not supported, only used once in the manual
+@node_handler(nodes.argument.Argument)
+def convert_argument(ctx, node, strip, markup):
+    ctx.report.add('arguments', node)
+    return convert_unsupported(ctx, node, strip, markup)
+
+
+@node_handler(nodes.comment.Comment)
+def convert_comment(ctx, node, strip, markup):
+    return ctx.comment(node, "Comment: %s" % (node))
+
+
+@node_handler(nodes.external_link.ExternalLink)
+def convert_external_link(ctx, node, strip, markup):
+    ctx.report.add('external_links', node)
+    if node.title:
+        return remarkup_parts([(node.title, True, markup), ' <', (node.url, True, markup), '>'], M_EXTLINK, markup)
+    else:
+        return [(node.url, strip, markup)]
+
+
+@node_handler(nodes.heading.Heading)
+def convert_heading(ctx, node, strip, markup):
+    ctx.report.add('headings', node)
+    title = node.title.strip()
+    return "\n%s\n%s\n" % (title, TITLE_CHARS[node.level] * len(title))
+
+
+#--------------------------------------------------------
+#   HTML Entities (&gt; &nbsp; ...)
+#--------------------------------------------------------
+@node_handler(nodes.html_entity.HTMLEntity)
+def convert_html_entity(ctx, node, strip, markup):
+    ctx.report.add('html_entities', node, node.value)
+    text = HTML_ENTITY_TO_TEXT.get(node.value)
+    if text is None:
+        return ctx.fixme(node, 'HTML Entity Unsupported %s' % node.value)
+    return text
+
+
+#--------------------------------------------------------
+#   HTML Tags (<tag>contents</tag>)
+#--------------------------------------------------------
+@node_handler(nodes.tag.Tag)
+def convert_tag(ctx, node, strip, markup):
+    tag = str(node.tag)
+    ctx.report.add('html_tags', node, tag)
+    handler = TAG_HANDLERS.get(tag)
+    if handler is None:
+        # TODO a couple of other HTML tags
+        return ctx.fixme(node, "Tag Unsupported:%s" % (node.tag))
+    return handler(ctx, node, strip, markup)
+
+
+@tag_handler(*TAG_TO_MARKUP)
+def tag_markup(ctx, node, strip, markup):
+    if strip:
+        return [(node.contents, True, markup)]
+    else:
+        next_markup = TAG_TO_MARKUP[str(node.tag)]
+        return remarkup_parts([(node.contents, strip, next_markup)], next_markup, markup)
+
+
+@tag_handler('dt')  # also matches ;
+def tag_dt(ctx, node, strip, markup):
+    # TODO
+    # probably not necessary to deal with, <dt> is unused in the
+    # wiki
+    return EMPTY_STRING
+
+
+@tag_handler('dd')  # also matches :
+def tag_dd(ctx, node, strip, markup):
+    if str(node) == ':':
+        return INDENTATION
+    else:  # <dd>item</dd> - unused in the wiki
+        return '%s' % indent((yield node.contents, strip, markup), INDENTATION)
+
+
+@tag_handler('br')
+def tag_br(ctx, node, strip, markup):
+    return '\n'
+
+
+@tag_handler('hr')  # also matches ----
+def tag_hr(ctx, node, strip, markup):
+    return '┴----┴'
+
+
+#<p>...</p> is ignored
+# rst does not support text alignment?
+@tag_handler('p', 'center')
+def tag_contents(ctx, node, strip, markup):
+    return [(node.contents, strip, markup)]
+
+
+@tag_handler('gallery')
+def tag_gallery(ctx, node, strip, markup):
+    # TODO <gallery> has additional options
+    # width and height could be supported (but only occurs three times in the manual)
+    # caption could be supported (but only occurs once)
+    gallery_images = []
+    for link in node.contents.strip().split('\n'):
+        if gallery_images:
+            gallery_images.append('\n')
+        gallery_images.append(
+            (mwparserfromhell.parse('[[%s]]' % link.strip()), True, markup))
+    return gallery_images
+
+
+@tag_handler('li')  # also matches # and *
+def tag_li(ctx, node, strip, markup):
+    if node.contents is not None:
+        return ctx.fixme(node, 'HTML lists not supported')
+    else:
+        return "°"
+
+
+@tag_handler('source', 'pre')
+def tag_source(ctx, node, strip, markup):
+    return '::\n┴%s\n\n' % indent((yield node.contents, strip, markup), INDENTATION)
+
+
+#--------------------------------------------------------
+#   Templates
+#--------------------------------------------------------
+@node_handler(nodes.template.Template)
+def convert_template(ctx, node, strip, markup):
+    name = node.name.strip().lower()
+    ctx.report.add('templates', node, name)
+    handler = TEMPLATE_HANDLERS.get(name)
+    if handler is None:
+        # TODO a couple of other templates
+        return ctx.fixme(node, 'Template Unsupported: %s' % node.name)
+    return handler(ctx, node, name, strip, markup)
+
+
+@template_handler('clr')
+def template_clr(ctx, node, name, strip, markup):
+    # TODO what is clr?
+    return ctx.delete(node, "clr")
+
+
+@template_handler('literal')
+def template_literal(ctx, node, name, strip, markup):
+    if strip:  # TODO warning?
+        return [(node.params[0].value, True, markup)]
+    else:
+        # there are a couple of pointless {Literal|} in the manual
+        if is_blank_param(node.params[0]):
+            return EMPTY_STRING
+        return remarkup_parts([(node.params[0], strip, M_GUILABEL)], M_GUILABEL, markup)
+
+
+@template_handler('menu')
+def template_menu(ctx, node, name, strip, markup):
+    items = []
+    for p in node.params:
+        if items:
+            items.append(' \u2192 ' if strip else ' --> ')
+        items.append((p.value, True, markup if strip else M_MENU))
+    if strip:
+        return ["[", *items, "]"]
+    else:
+        return remarkup_parts(items, M_MENU, markup)
+
+
+@template_handler('note', 'nicetip')
+def template_admonition(ctx, node, name, strip, markup):
+    if len(node.params) == 2:  # with title
+        title = (yield node.params[0], False, markup).strip()
+        return rst_admonition(name, title, [(yield node.params[1], False, markup)])
+    else:  # without title
+        title = 'Note' if name == 'note' else 'Tip'
+        return rst_admonition(name, title, [(yield node.params[0], False, markup)])
+
+
+@template_handler('warning/important')
+def template_warning(ctx, node, name, strip, markup):
+    # this isnt really converting to RST well, body is outside of template:
+    return rst_directive("warning", "", ["FIXME - warning body below"])
+
+
+@template_handler('page/header', 'page/footer')
+def template_page(ctx, node, name, strip, markup):
+    return ctx.delete(node, "Template %s" % name.title())
+
+
+@template_handler('refbox')
+def template_refbox(ctx, node, name, strip, markup):
+    name_to_index = {
+        'mode': 0, 'panel': 1, 'menu': 2, 'hotkey': 3, 'lang': 4}
+    template = ['| Mode:     %s',
+                '| Panel:    %s',
+                '| Menu:     %s',
+                '| Hotkey:   %s',
+                EMPTY_STRING]
+    template_args = [None] * len(template)
+    for index, param in enumerate(node.params):
+        c = (yield param, False, markup).strip()
+        if param.showkey:  # argument by name
+            template_args[
+                name_to_index[str(param.name).lower().strip()]] = c
+        else:  # argument by index
+            template_args[index] = c
+
+    body = []
+    for ts, arg in zip(template, template_args):
+        if ts != EMPTY_STRING:
+            if arg is not None:
+                if arg != "":
+                    body.append(ts % arg)
+    return rst_admonition('refbox', 'Reference', body)
+
+
+@template_handler('review', 'wikitask/inprogress', 'wikitask/todo')
+def template_review(ctx, node, name, strip, markup):
+    return ctx.comment(node, "TODO/Review: %s" % (node))
+
+
+@template_handler('shortcut', 'button')
+def template_shortcut(ctx, node, name, strip, markup):
+    keys = []
+    for p in node.params:
+        if keys:
+            keys.append('][' if strip else '-')
+        keys.append((p.value, True, markup if strip else M_KBD))
+    if strip:
+        return ['[', *keys, ']']
+    else:
+        return remarkup_parts(keys, M_KBD, markup)
+
+
+@template_handler('abbr')
+def template_abbr(ctx, node, name, strip, markup):
+    if strip:
+        return '%s (%s)' % ((yield node.params[0], True, markup).strip(), node.params[1].strip())
+    else:
+        return remarkup('%s (%s)' % ((yield node.params[0], True, M_ABBR).strip(), node.params[1].strip()), M_ABBR, markup)
+
+
+@template_handler('table')
+def template_table(ctx, node, name, strip, markup):
+    rows = []
+    current_row = []
+    rows.append(current_row)
+    for param in node.params:
+        if param.showkey:
+            # this is an option for this row, ignored
+            # TODO
+            pass
+        else:
+            content = (yield param.value, False, markup).strip()
+            # see template_css_prettytable()
+            if content == 'IGNORE':
+                pass
+            # happens with '| a || b || c' syntax
+            elif content == '':
+                pass
+            elif content == '-':
+                # start new row, unless previous is empty
+                if current_row:
+                    current_row = []
+                    rows.append(current_row)
             else:
-                # TODO a couple of other HTML tags
-                return FIXME(node, "Tag Unsupported:%s" % (node.tag))
-
-        #--------------------------------------------------------
-        #   Templates
-        #--------------------------------------------------------
-        elif isinstance(node, nodes.template.Template):
-            name = node.name.strip().lower()
-            report.templates[name].append(node)
-
-            if name == 'clr':
-                # TODO what is clr?
-                return DELETE(node, "clr")
-
-            elif name == 'literal':
-                if strip:  # TODO warning?
-                    return convert(node.params[0].value, True, markup)
-                else:
-                    # there are a couple of pointless {Literal|} in the manual
-                    if node.params[0].strip() == EMPTY_STRING:
-                        return EMPTY_STRING
-                    return remarkup(convert(node.params[0], strip, M_GUILABEL), M_GUILABEL, markup)
-
-            elif name == 'menu':
-                if strip:
-                    return "[%s]" % (' \u2192 '.join(convert(p.value, True, markup) for p in node.params))
-                else:
-                    return remarkup(' --> '.join(convert(p.value, True, M_MENU) for p in node.params), M_MENU, markup)
-
-            elif name == 'note':
-                if len(node.params) == 2:  # with title
-                    return rst_admonition(name, convert(node.params[0], False, markup).strip(), [convert(node.params[1], False, markup)])
-                else:  # without title
-                    return rst_admonition(name, 'Note', [convert(node.params[0], False, markup)])
-
-            elif name == 'nicetip':
-                if len(node.params) == 2:  # with title
-                    return rst_admonition(name, convert(node.params[0], False, markup).strip(), [convert(node.params[1], False, markup)])
-                else:  # without title
-                    return rst_admonition(name, 'Tip', [convert(node.params[0], False, markup)])
-            elif name == 'warning/important':
-                # this isnt really converting to RST well, body is outside of template:
-                return rst_directive("warning", "", ["FIXME - warning body below"])
-
-            elif name == 'page/header':
-                return DELETE(node, "Template Page/Header")
-
-            elif name == 'page/footer':
-                return DELETE(node, "Template Page/Footer")
-
-            elif name == 'refbox':
-                name_to_index = {
-                    'mode': 0, 'panel': 1, 'menu': 2, 'hotkey': 3, 'lang': 4}
-                template = ['| Mode:     %s',
-                            '| Panel:    %s',
-                            '| Menu:     %s',
-                            '| Hotkey:   %s',
-                            EMPTY_STRING]
-                template_args = [None] * len(template)
-                for index, param in enumerate(node.params):
-                    c = convert(param, False, markup).strip()
-                    if param.showkey:  # argument by name
-                        template_args[
-                            name_to_index[str(param.name).lower().strip()]] = c
-                    else:  # argument by index
-                        template_args[index] = c
-
-                body = []
-                for ts, arg in zip(template, template_args):
-                    if ts != EMPTY_STRING:
-                        if arg is not None:
-                            if arg != "":
-                                body.append(ts % arg)
-                return rst_admonition('refbox', 'Reference', body)
-
-            elif name in {'review', 'wikitask/inprogress', 'wikitask/todo'}:
-                return COMMENT(node, "TODO/Review: %s" % (node))
-
-            elif name in {'shortcut', 'button'}:
-                if strip:
-                    return '[%s]' % (']['.join(convert(p.value, True, markup) for p in node.params))
-                else:
-                    return remarkup('-'.join(convert(p.value, True, M_KBD) for p in node.params), M_KBD, markup)
+                current_row.append(content)
+
+    return "\n%s\n" % rst_paint_table(rows)
+
+
+@template_handler('css/prettytable')
+def template_css_prettytable(ctx, node, name, strip, markup):
+    return 'IGNORE'
+
+
+#--------------------------------------------------------
+#   Wiki Links (includes Doc,Image,File ...)
+#--------------------------------------------------------
+# image options of wikilinks, like '[[File:Name.png|thumb|left|512px|Caption]]'
+# '512x256px' to specify both width and height, 'x256px' for height only and '512px' or '512 px' for width only
+WIKILINK_SIZE_RE = re.compile(r"(?:(\d{1,6})x(\d{1,6})|x(\d{1,6})|(\d{1,6})\s?)px")
+WIKILINK_ALIGN = frozenset(('left', 'right', 'center', 'none'))
+WIKILINK_VALIGN = frozenset(('baseline', 'sub', 'super', 'top', 'text-top', 'middle', 'bottom', 'text-bottom'))
+WIKILINK_FORMAT = frozenset(('border', 'frameless', 'frame', 'thumb'))
+
 
-            elif name == 'abbr':
-                if strip:
-                    return '%s (%s)' % (convert(node.params[0], True, markup).strip(), node.params[1].strip())
+def wikilink_options(text):
+    """
+    Split the text of a wikilink into options, the same way the parameters of a template are split.
+    Yields (key, value) tuples, key is None for positional options and value is Wikicode.
+    """
+    if any(isinstance(n, (nodes.heading.Heading, nodes.external_link.ExternalLink)) or
+           isinstance(n, nodes.text.Text) and ('{' in n.value or '}' in n.value or '\n' in n.value)
+           for n in text.nodes):
+        # in a template, braces may combine with the surrounding nodes differently
+        # and line breaks change which '=' starts a value, let the parser decide
+        # (in a wikilink, a free URL swallows the '|' separators that follow it)
+        for param in mwparserfromhell.parse("{{Dummy|%s}}" % text).nodes[0].params:
+            yield (str(param.name) if param.showkey else None), param.value
+        return
+
+    # only '|' and '=' in plain text take part in splitting, nested nodes are kept as they are
+    key = None
+    value = []
+    for node in text.nodes:
+        if not isinstance(node, nodes.text.Text):
+            value.append(node)
+            continue
+        for i, part in enumerate(node.value.split('|')):
+            if i:
+                yield key, Wikicode(SmartList(value))
+                key = None
+                value = []
+            if key is None and '=' in part:
+                key_part, _, part = part.partition('=')
+                if key_part:
+                    value.append(nodes.Text(key_part))
+                key = str(Wikicode(SmartList(value)))
+                value = []
+            if part:
+                value.append(nodes.Text(part))
+    yield key, Wikicode(SmartList(value))
+
+
+@node_handler(nodes.wikilink.Wikilink, memo=True)
+def convert_wikilink(ctx, node, strip, markup):
+    full_link = str(node.title)
+    # some links have ':' prepended for some reason
+    link_split = full_link.lstrip(':').split(':')
+    namespace = None
+    link_target = None
+    if len(link_split) == 2:
+        namespace = link_split[0].lower().strip()
+        link_target = link_split[1].strip()
+    else:
+        return ctx.fixme(node, "TODO: Internal Link")
+    ctx.report.add('wikilinks', node, str(namespace))
+    options = {}
+
+    caption = None
+    text = node.text
+    if text is not None:
+        # mwparserfromhell doesn't bother parsing arguments for WikiLinks
+        for key, value in wikilink_options(text):
+            val_original = yield value, strip, markup
+            if key is not None:
+                # 'link', 'alt', 'page', 'class' and 'lang' are not used
+                continue
+            val = val_original.strip().lower()
+            m = WIKILINK_SIZE_RE.match(val)
+            if m is not None:
+                width, height, height_only, width_only = m.groups()
+                if width is not None:
+                    # not used, but no problem to have
+                    options['width'] = width
+                    options['height'] = height
+                elif height_only is not None:
+                    options['height'] = height_only
                 else:
-                    return remarkup('%s (%s)' % (convert(node.params[0], True, M_ABBR).strip(), node.params[1].strip()), M_ABBR, markup)
-
-            elif name == 'table':
-                rows = []
-                current_row = []
-                rows.append(current_row)
-                for param in node.params:
-                    if param.showkey:
-                        # this is an option for this row, ignored
-                        # TODO
-                        pass
-                    else:
-                        content = convert(param.value, False, markup).strip()
-                        # see below
-                        if content == 'IGNORE':
-                            pass
-                        # happens with '| a || b || c' syntax
-                        elif content == '':
-                            pass
-                        elif content == '-':
-                            # start new row, unless previous is empty
-                            if current_row:
-                                current_row = []
-                                rows.append(current_row)
-                        else:
-                            current_row.append(content)
-
-                return "\n%s\n" % rst_paint_table(rows)
-
-            if name == 'css/prettytable':
-                return 'IGNORE'
-
-            # TODO a couple of other templates
-            else:
-                return FIXME(node, 'Template Unsupported: %s' % node.name)
-
-        #--------------------------------------------------------
-        #   Wiki Links (includes Doc,Image,File ...)
-        #--------------------------------------------------------
-        elif isinstance(node, nodes.wikilink.Wikilink):
-            full_link = str(node.title)
-            # some links have ':' prepended for some reason
-            link_split = full_link.lstrip(':').split(':')
-            namespace = None
-            link_target = None
-            if len(link_split) == 2:
-                namespace = link_split[0].lower().strip()
-                link_target = link_split[1].strip()
-            else:
-                return FIXME(node, "TODO: Internal Link")
-            report.wikilinks[str(namespace)].append(node)
-            options = {}
-
-            caption = None
-            text = node.text
-            if text is not None:
-                # mwparserfromhell doesn't bother parsing arguments for WikiLinks
-                # the template argument parsing feature is reused instead
-                ast = mwparserfromhell.parse("{{Dummy|%s}}" % text)
-                # parse options, if any
-                for param in ast.nodes[0].params:
-                    # empty arg, like '[Namespace:Link|options|]'
-                    if param.value is None:
-                        continue
-                    val_original = convert(param.value, strip, markup)
-                    val = val_original.strip().lower()
-                    if param.showkey:
-                        key = param.name
-                        if key == 'link':
-                            pass
-                        elif key == 'alt':
-                            pass
-                        elif key == 'page':
-                            pass
-                        elif key == 'class':
-                            pass
-                        elif key == 'lang':
-                            pass
-                        continue
-                    else:
-                        # like '512x256px' to specify both width and height
-                        # not used, but no problem to have
-                        m = re.match(r"(\d{1,6})x(\d{1,6})px", val)
-                        if m is not None:
-                            width, height = m.groups()
-                            options['width'] = width
-                            options['height'] = height
-                            continue
-                        else:
-                            # like 'x256px' to specify height only
-                            m = re.match(r'x(\d{1,6})px', val)
-                            if m is not None:
-                                options['height'] = m.groups(0)[0]
-                                continue
-                            # like '512px' or '512 px' to specify width only
-                            else:
-                                m = re.match(r'(\d{1,6})\s{0,1}px', val)
-                                if m is not None:
-                                    options['width'] = m.groups(0)[0]
-                                    continue
-                        if val == '':
-                            pass
-                        elif val in {'left', 'right', 'center', 'none'}:
-                            if val != 'none':
-                                if ENABLE_IMAGE_ALIGNMENT:
-                                    options['align'] = val
-                        elif val in {'baseline', 'sub', 'super', 'top', 'text-top', 'middle', 'bottom', 'text-bottom'}:
-                            pass
-                        elif val in {'border', 'frameless', 'frame', 'thumb'}:
-                            pass
-                        # this must be the caption (if we're at the last item)
-                        # or some unrecognized/malformed parameter
-                        else:
-                            if caption is not None:
-                                print(
-                                    "WARNING: previous caption '%s' overwritten with '%s'" %
-                                    (caption, val_original))
-                            #caption = val_original
-                            caption = convert(param.value, True, markup)
-            # link conversion
-            if namespace is None:
-                # TODO Internal Links
+                    options['width'] = width_only
+            elif val == '':
                 pass
-            elif namespace == 'doc':  # TODO
-                if caption is None:
-                    return remarkup(wikipath_to_rstpath(link_target), M_DOC, markup)
-                else:
-                    return remarkup('%s <%s>' % (caption.strip(), wikipath_to_rstpath(link_target)), M_DOC, markup)
-
-            elif namespace in {'file', 'image', 'media'}:
-                if is_image_file(link_target):
-                    # embed image
-                    #header = "\n\n.. figure:: /images/%s" % (link_target.replace(" ", "_").replace(".PNG", ".jpg").replace(".png", ".jpg"))
-                    header = "\n\n.. figure:: /images/%s" % (link_target.replace(" ", "_"))
-                    body = []
-                    if 'width' in options:
-                        width = int(options['width'])
-                        # could experiment with width/figwidth here
-                        # same values seems to look best however
-                        body.append(":width: %dpx" % width)
-                        body.append(":figwidth: %dpx" % width)
-                    if 'height' in options:
-                        body.append(":height: %spx" % options['height'])
-                    if 'align' in options:
-                        body.append(":align: %s" % options['align'])
-                    if caption is not None:
-                        body.append(EMPTY_STRING)
-                        body.append(caption.lstrip())
-                    return "%s\n%s\n\n" % (header, indent('\n'.join(body), INDENTATION))
-                else:
-                    # create link to file on Wiki
-                    if caption is None:
-                        return remarkup("File:%s <%s>" % (link_target, wikiurl(full_link)), M_EXTLINK, markup)
-                    else:  # TODO unmarked external links seem undesirable
-                        return remarkup("%s <%s>" % (caption, wikiurl(full_link)), M_EXTLINK, markup)
-
-            elif namespace == 'user':
-                if caption is None:
-                    return "`Wiki User:%s <%s>`__" % (link_target, wikiurl(full_link))
-                else:  # TODO unmarked external links seem undesirable
-                    return remarkup("%s <%s>" % (caption, wikiurl(full_link)), M_EXTLINK, markup)
-
-            elif namespace == 'extensions':
-                if caption is None:
-                    return "`Extensions:%s <%s>`__" % (link_target, wikiurl(full_link))
-                else:  # TODO unmarked external links seem undesirable
-                    return remarkup("%s <%s>" % (caption, wikiurl(full_link)), M_EXTLINK, markup)
-
-            elif namespace == 'category':
-                # TODO?
-                return DELETE(node, "Categories not supported")
-
-            # TODO a few other namespaces
-            elif namespace == 'help':
+            elif val in WIKILINK_ALIGN:
+                if val != 'none':
+                    if ENABLE_IMAGE_ALIGNMENT:
+                        options['align'] = val
+            elif val in WIKILINK_VALIGN or val in WIKILINK_FORMAT:
                 pass
+            # this must be the caption (if we're at the last item)
+            # or some unrecognized/malformed parameter
+            else:
+                if caption is not None:
+                    ctx.message(
+                        "WARNING: previous caption '%s' overwritten with '%s'" %
+                        (caption, val_original))
+                #caption = val_original
+                caption = yield value, True, markup
+    # link conversion
+    if namespace is None:
+        # TODO Internal Links
+        pass
+    elif namespace == 'doc':  # TODO
+        if caption is None:
+            return remarkup(wikipath_to_rstpath(link_target), M_DOC, markup)
+        else:
+            return remarkup('%s <%s>' % (caption.strip(), wikipath_to_rstpath(link_target)), M_DOC, markup)
+
+    elif namespace in {'file', 'image', 'media'}:
+        if is_image_file(link_target):
+            # embed image
+            #header = "\n\n.. figure:: /images/%s" % (link_target.replace(" ", "_").replace(".PNG", ".jpg").replace(".png", ".jpg"))
+            image = link_target.replace(" ", "_")
+            header = "\n\n.. figure:: /images/%s" % (image)
+            ctx.report.add('images', node, (
+                image,
+                int(options['width']) if 'width' in options else None,
+                int(options['height']) if 'height' in options else None,
+                ))
+            body = []
+            if 'width' in options:
+                width = int(options['width'])
+                # could experiment with width/figwidth here
+                # same values seems to look best however
+                body.append(":width: %dpx" % width)
+                body.append(":figwidth: %dpx" % width)
+            if 'height' in options:
+                body.append(":height: %spx" % options['height'])
+            if 'align' in options:
+                body.append(":align: %s" % options['align'])
+            if caption is not None:
+                body.append(EMPTY_STRING)
+                body.append(caption.lstrip())
+            return "%s\n%s\n\n" % (header, indent('\n'.join(body), INDENTATION))
+        else:
+            # create link to file on Wiki
+            if caption is None:
+                return remarkup("File:%s <%s>" % (link_target, wikiurl(full_link)), M_EXTLINK, markup)
+            else:  # TODO unmarked external links seem undesirable
+                return remarkup("%s <%s>" % (caption, wikiurl(full_link)), M_EXTLINK, markup)
+
+    elif namespace == 'user':
+        if caption is None:
+            return "`Wiki User:%s <%s>`__" % (link_target, wikiurl(full_link))
+        else:  # TODO unmarked external links seem undesirable
+            return remarkup("%s <%s>" % (caption, wikiurl(full_link)), M_EXTLINK, markup)
+
+    elif namespace == 'extensions':
+        if caption is None:
+            return "`Extensions:%s <%s>`__" % (link_target, wikiurl(full_link))
+        else:  # TODO unmarked external links seem undesirable
+            return remarkup("%s <%s>" % (caption, wikiurl(full_link)), M_EXTLINK, markup)
 
-            return FIXME(node, "Link Type Unsupported: %s" % namespace)
-        return FIXME(node, "Type Unsupported: %s" % type(node).__name__)
-    return convert(start_node, False, None), report
+    elif namespace == 'category':
+        # TODO?
+        return ctx.delete(node, "Categories not supported")
+
+    # TODO a few other namespaces
+    elif namespace == 'help':
+        pass
+
+    return ctx.fixme(node, "Link Type Unsupported: %s" % namespace)
+
+
+# convert a mwparserfromhell MediaWiki AST to a string
+# returns a tuple with the (already postprocessed) RST string and the ConversionReport
+# a ConversionReport may optionally be passed to gather information across
+# multiple invocations
+def convert_mw(start_node, report=None):
+    if report is None:
+        report = ConversionReport()
+    ctx = ConversionContext(report)
+    return ctx.convert(start_node, False, None), report
 
 
 def print_report(report, target):
     print("Conversion Report:\n", file=target)
 
-    def print_summary(name, report_item):
+    def print_summary(name, field, examples=False):
         print(name + ':', file=target)
         total = 0
-        for reason, issues in sorted(report_item.items()):
-            count = len(issues)
+        for reason, count in sorted(getattr(report, field).items()):
             print("  %s: %d" % (reason, count), file=target)
+            if examples:
+                for sample in report.samples.get((field, reason), ()):
+                    print("    e.g. %s" % sample.replace("\n", " "), file=target)
             total += count
         print("\n  Total:%s\n" % total, file=target)
 
-    print_summary("FIXME", report.fixme)
-    print_summary("Deleted", report.deleted)
-    print_summary("Templates used", report.templates)
-    print_summary("HTML Entities", report.html_entities)
-    print_summary("HTML Tags", report.html_tags)
-    print_summary("Wiki Links", report.wikilinks)
+    print_summary("FIXME", "fixme", examples=True)
+    print_summary("Deleted", "deleted")
+    print_summary("Templates used", "templates")
+    print_summary("HTML Entities", "html_entities")
+    print_summary("HTML Tags", "html_tags")
+    print_summary("Wiki Links", "wikilinks")
+
+    print("Memoized conversions:", file=target)
+    for kind in sorted(report.memo_hits.keys() | report.memo_misses.keys()):
+        hits = report.memo_hits[kind]
+        total = hits + report.memo_misses[kind]
+        print("  %s: %d of %d from memo (%d%%)" % (kind, hits, total, hits * 100 // total), file=target)
+    print(file=target)
+
+
+# config values that change the output of the conversion,
+# see converter_fingerprint()
+FINGERPRINT_CONFIG = (
+    "ENABLE_IMAGE_ALIGNMENT",
+    "WIKI_HOST",
+    "TITLE_PREFIX",
+    "INDENTATION",
+    "TITLE_CHARS",
+    "USE_PEDANTIC",
+    "WIDTH",
+    "TABLE_MAX_WIDTH",
+    "TABLE_MAX_CELLS",
+    "MEMO_SIZE",
+    "MEMO_PROBE",
+)
+
+
+def converter_fingerprint():
+    """
+    Return a hash of the converter source and its config,
+    if this changes, previously converted pages may be out of date.
+    """
+    import hashlib
+    h = hashlib.sha1()
+    with open(__file__, 'rb') as f:
+        h.update(f.read())
+    h.update(mwparserfromhell.__version__.encode('utf-8'))
+    for name in FINGERPRINT_CONFIG:
+        h.update(("%s=%r\n" % (name, globals()[name])).encode('utf-8'))
+    return h.hexdigest()
+
+
+def parse_mw(mw, ast_cache=None):
+    """
+    Parse (preprocessed) MediaWiki code.
+
+    ast_cache: optional directory of pickled parse trees,
+    keyed by the text and the mwparserfromhell version.
+    Files are touched when used, see ast_cache_trim() to remove the least recently used ones.
+    """
+    if ast_cache is None:
+        return mwparserfromhell.parse(mw)
+
+    import gc
+    import hashlib
+    import pickle
+    h = hashlib.sha1(mwparserfromhell.__version__.encode('utf-8'))
+    h.update(b'\n')
+    h.update(mw.encode('utf-8'))
+    cache_file = os.path.join(ast_cache, h.hexdigest() + ".pickle")
+
+    try:
+        with open(cache_file, 'rb') as f:
+            data = f.read()
+    except OSError:
+        data = None
+    if data is not None:
+        # unpickling creates many objects at once, garbage collection only slows it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            rst_ast = pickle.loads(data)
+        except (EOFError, pickle.UnpicklingError):
+            rst_ast = None
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if rst_ast is not None:
+            try:
+                os.utime(cache_file)
+            except OSError:
+                pass
+            return rst_ast
+
+    rst_ast = mwparserfromhell.parse(mw)
+    try:
+        data = pickle.dumps(rst_ast, protocol=pickle.HIGHEST_PROTOCOL)
+    except RecursionError:
+        # too deeply nested to pickle, this page is parsed every time
+        return rst_ast
+    os.makedirs(ast_cache, exist_ok=True)
+    # other processes may read the same file, only rename it into place once it's complete
+    cache_file_tmp = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(cache_file_tmp, 'wb') as f:
+        f.write(data)
+    os.replace(cache_file_tmp, cache_file)
+    return rst_ast
+
+
+def ast_cache_trim(ast_cache, size_limit):
+    """
+    Remove the least recently used parse trees from the parse_mw() cache directory,
+    until it uses at most size_limit bytes.
+    """
+    try:
+        entries = list(os.scandir(ast_cache))
+    except FileNotFoundError:
+        return
+    files = []
+    total = 0
+    for entry in entries:
+        if entry.name.endswith(".tmp"):
+            # left over from an interrupted run
+            os.remove(entry.path)
+        elif entry.name.endswith(".pickle"):
+            st = entry.stat()
+            files.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+    files.sort()
+    for mtime, size, path in files:
+        if total <= size_limit:
+            break
+        os.remove(path)
+        total -= size
+
+
+def write_if_changed(path, text):
+    """
+    Write 'text' to 'path', unless the file already holds exactly this text,
+    so unchanged files keep their modification time (and Sphinx doesn't rebuild them).
+
+    The file is replaced atomically, returns True when it was written.
+    """
+    data = text.encode('utf-8')
+    try:
+        # only read files which could match
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except FileNotFoundError:
+        pass
+    path_tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(path_tmp, 'wb') as f:
+            f.write(data)
+        os.replace(path_tmp, path)
+    except BaseException:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+        raise
+    return True
+
+
+# stages of example_usage(), see its 'timing' and 'memory' arguments
+STAGES = ("preprocess", "parse", "convert", "postprocess", "write")
+
+# highest traced memory of this process before the last tracemalloc.reset_peak(), see memory_peak()
+_memory_peak = 0
+
+
+def process_memory():
+    """
+    Start tracing memory allocations in this process (when not already tracing).
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
 
 
-def example_usage(mediawiki_string, output_file, report_file=None):
-    rst_ast = mwparserfromhell.parse(preprocess(mediawiki_string))
+def memory_peak():
+    """
+    Returns the highest traced memory of this process (in bytes), since process_memory().
+    """
+    return max(_memory_peak, tracemalloc.get_traced_memory()[1])
+
+
+class StageMeter:
+    """
+    Measures the time and the peak of traced memory of consecutive stages,
+    each stage starts where the previous one stopped.
+    """
+    __slots__ = (
+        "timing",
+        "memory",
+        "_time",
+        "_memory_start",
+        "_memory_base",
+        )
+
+    def __init__(self, timing=None, memory=None):
+        self.timing = timing
+        self.memory = memory
+        if memory is not None:
+            memory["peak"] = 0
+            self._memory_base = tracemalloc.get_traced_memory()[0]
+        self._start()
+
+    def _start(self):
+        if self.memory is not None:
+            global _memory_peak
+            # keep the process peak, which tracemalloc forgets on reset
+            _memory_peak = memory_peak()
+            tracemalloc.reset_peak()
+            self._memory_start = tracemalloc.get_traced_memory()[0]
+        if self.timing is not None:
+            self._time = perf_counter()
+
+    def stop(self, stage):
+        if self.timing is not None:
+            self.timing[stage] = perf_counter() - self._time
+        if self.memory is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            # allocated on top of what the stage started with
+            self.memory[stage] = peak - self._memory_start
+            # allocated on top of what the page started with
+            self.memory["peak"] = max(self.memory["peak"], peak - self._memory_base)
+        self._start()
+
+
+def example_usage(mediawiki_string, output_file, report_file=None, ast_cache=None, timing=None, memory=None):
+    """
+    timing: optional dict, filled with the time spent in each of STAGES (in seconds).
+    memory: optional dict, filled with the peak memory allocated in each of STAGES
+       and for the whole page as 'peak' (in bytes), requires process_memory().
+    """
+    meter = StageMeter(timing, memory)
+    mw = preprocess(mediawiki_string)
+    meter.stop("preprocess")
+    rst_ast = parse_mw(mw, ast_cache)
+    meter.stop("parse")
     rst_pre, report = convert_mw(rst_ast)
+    meter.stop("convert")
     rst = postprocess(rst_pre)
-    with open(output_file, "w+", encoding='utf-8') as f:
-        f.write(rst)
+    meter.stop("postprocess")
+    write_if_changed(output_file, rst)
+    meter.stop("write")
     # Save a report only if a report_file is specified
     if report_file:
-        with open(report_file, "w+", encoding='utf-8') as f:
-            print_report(report, f)
+        import io
+        f = io.StringIO()
+        print_report(report, f)
+        write_if_changed(report_file, f.getvalue())
+    return report
+
+
+# profiler of this process, see example_usage_mp()
+_profile = None
+
+
+def process_profile(profile_dir):
+    """
+    Returns a cProfile.Profile for this process, its stats are written to
+    'profile_dir' (one file for each process) when the process exits.
+    Merge them with: pstats.Stats(*glob.glob(os.path.join(profile_dir, "*.prof")))
+    """
+    global _profile
+    if _profile is None:
+        _profile = cProfile.Profile()
+        os.makedirs(profile_dir, exist_ok=True)
+        # runs on exit of pool workers, as well as of the main process
+        multiprocessing.util.Finalize(
+            None, _profile.dump_stats,
+            args=(os.path.join(profile_dir, "process_%d.prof" % os.getpid()),),
+            exitpriority=10)
+    return _profile
+
 
 # for use with multiprocess
-def example_usage_mp(pair, report_file=None):
-    example_usage(*pair, report_file=report_file)
+# returns the output file, the report, the timing of each stage with the page size (or None)
+# and the memory use of each stage with the peak of the process (or None),
+# so reports can be combined by the caller
+#
+# timing: when True, the time of each stage is measured, see example_usage()
+# memory: when True, memory allocations are traced, see example_usage()
+# profile_dir: when set, pages are converted under cProfile, see process_profile()
+def example_usage_mp(pair, report_file=None, ast_cache=None, timing=False, memory=False, profile_dir=None):
+    timing = {} if timing else None
+    if memory:
+        memory = {}
+        process_memory()
+    else:
+        memory = None
+    kwargs = dict(report_file=report_file, ast_cache=ast_cache, timing=timing, memory=memory)
+    if profile_dir is not None:
+        profile = process_profile(profile_dir)
+        profile.enable()
+        try:
+            report = example_usage(*pair, **kwargs)
+        finally:
+            profile.disable()
+    else:
+        report = example_usage(*pair, **kwargs)
+    if timing is not None:
+        timing["chars"] = len(pair[0])
+    if memory is not None:
+        memory["pid"] = os.getpid()
+        memory["process"] = memory_peak()
+        # kilobytes on Linux
+        memory["process_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pair[1], report, timing, memory
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Benchmark of the whole conversion (preprocess, parse, convert, postprocess, write)
+# over the MediaWiki dump and scaled up copies of it, each case is the fastest of several runs.
+#
+# Results are written as JSON, pass a previous result as the baseline
+# to fail (exit code 1) when a case got slower or uses more memory.
+#
+#   python3 blmw_to_rst_bench.py --output bench.json
+#   python3 blmw_to_rst_bench.py --baseline bench.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import multiprocessing
+import blmw_to_rst
+import blmw_to_rst_migrate
+
+WIKI_XML_PATH = blmw_to_rst_migrate.WIKI_XML_PATH
+# number of copies of the dump to convert, each scale is a separate case
+SCALES = (1, 10, 100)
+# 'inprocess' converts in the benchmark process, 'multiprocess' uses a pool set up like the migration's
+# (blmw_to_rst_migrate.MAX_TASKS_PER_CHILD, largest pages first within SCHEDULE_WINDOW)
+MODES = ("inprocess", "multiprocess")
+# number of worker processes, 0 for one per CPU
+JOB_TOTAL = 0
+# allowed slow down (or growth of peak memory) compared to the baseline, as a fraction
+TOLERANCE = 0.10
+# each case runs at least this many times and for at least MIN_SECONDS in total, the fastest run is used
+REPEAT = 3
+MIN_SECONDS = 5.0
+
+
+def convert_page_timed(pair):
+    """
+    Convert (page_text, output_file), returns the time spent in each of blmw_to_rst.STAGES.
+    """
+    timing = {}
+    blmw_to_rst.example_usage(*pair, timing=timing)
+    return timing
+
+
+def quiet():
+    # the converter prints FIXME's, these would only distort the timing
+    sys.stdout = open(os.devnull, 'w')
+
+
+def peak_rss_kb(who):
+    # kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss
+
+
+def run_case(mode, scale, repeat, output_dir, result):
+    quiet()
+    pages = [page_text for page_title, page_text in blmw_to_rst_migrate.wiki_pages(WIKI_XML_PATH)]
+
+    # the fastest run is the one least disturbed by other load on the machine
+    seconds = stages = None
+    runs = 0
+    seconds_total = 0.0
+    while runs < repeat or seconds_total < MIN_SECONDS:
+        # each run writes to an empty directory, unchanged files would be skipped otherwise
+        run_dir = os.path.join(output_dir, "run")
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.mkdir(run_dir)
+        args = [
+            (page_text, os.path.join(run_dir, "%d_%d.rst" % (copy, i)))
+            for copy in range(scale)
+            for i, page_text in enumerate(pages)
+        ]
+        stages_run = dict.fromkeys(blmw_to_rst.STAGES, 0.0)
+        t = time.perf_counter()
+        if mode == "inprocess":
+            times_all = map(convert_page_timed, args)
+        else:
+            pool = multiprocessing.Pool(processes=JOB_TOTAL or multiprocessing.cpu_count(), initializer=quiet,
+                                        maxtasksperchild=blmw_to_rst_migrate.MAX_TASKS_PER_CHILD)
+            times_all = pool.imap_unordered(
+                convert_page_timed,
+                blmw_to_rst_migrate.schedule_largest_first(args, blmw_to_rst_migrate.SCHEDULE_WINDOW),
+                chunksize=1,
+            )
+        for timing in times_all:
+            for stage, t_stage in timing.items():
+                stages_run[stage] += t_stage
+        if mode != "inprocess":
+            pool.close()
+            pool.join()
+        t = time.perf_counter() - t
+        runs += 1
+        seconds_total += t
+        if seconds is None or t < seconds:
+            seconds, stages = t, stages_run
+
+    shutil.rmtree(run_dir)
+    size = sum(len(page_text.encode('utf-8')) for page_text, output_file in args)
+    result.update({
+        "name": "%s-x%d" % (mode, scale),
+        "mode": mode,
+        "scale": scale,
+        "pages": len(args),
+        "runs": runs,
+        "bytes": size,
+        "seconds": seconds,
+        "pages_per_sec": len(args) / seconds,
+        "mb_per_sec": size / (1024 * 1024) / seconds,
+        "peak_rss_kb": peak_rss_kb(resource.RUSAGE_SELF),
+        "peak_rss_workers_kb": peak_rss_kb(resource.RUSAGE_CHILDREN),
+        # summed over all pages, for 'multiprocess' this is the time spent in all workers
+        "stages": stages,
+    })
+
+
+def run_case_isolated(mode, scale, repeat):
+    # each case runs in a fresh process, so the peak memory use is its own
+    import tempfile
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as output_dir, ctx.Manager() as manager:
+        result = manager.dict()
+        proc = ctx.Process(target=run_case, args=(mode, scale, repeat, output_dir, result))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            raise Exception("benchmark case %s-x%d failed" % (mode, scale))
+        return dict(result)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of regressions compared to the baseline results.
+    """
+    baseline_cases = {case["name"]: case for case in baseline["results"]}
+    regressions = []
+    for case in results["results"]:
+        case_base = baseline_cases.get(case["name"])
+        if case_base is None:
+            continue
+        if case["pages_per_sec"] < case_base["pages_per_sec"] * (1.0 - tolerance):
+            regressions.append("%s: %.1f pages/sec, baseline %.1f" % (
+                case["name"], case["pages_per_sec"], case_base["pages_per_sec"]))
+        if case["peak_rss_kb"] > case_base["peak_rss_kb"] * (1.0 + tolerance):
+            regressions.append("%s: peak RSS %d KB, baseline %d KB" % (
+                case["name"], case["peak_rss_kb"], case_base["peak_rss_kb"]))
+    return regressions
+
+
+def main():
+    import argparse
+    import mwparserfromhell
+    parser = argparse.ArgumentParser(description="Benchmark the wiki to RST conversion.")
+    parser.add_argument("--scales", default=",".join(str(scale) for scale in SCALES),
+                        help="comma separated number of copies of the dump (default: %(default)s)")
+    parser.add_argument("--modes", default=",".join(MODES),
+                        help="comma separated modes (default: %(default)s)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="allowed regression as a fraction (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=REPEAT,
+                        help="minimum runs of each case, the fastest is used (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = {
+        "python": sys.version.split()[0],
+        "mwparserfromhell": mwparserfromhell.__version__,
+        "cpu_count": multiprocessing.cpu_count(),
+        "fingerprint": blmw_to_rst.converter_fingerprint(),
+        "results": [],
+    }
+    for mode in args.modes.split(","):
+        for scale in args.scales.split(","):
+            case = run_case_isolated(mode, int(scale), args.repeat)
+            results["results"].append(case)
+            print("%-20s %8.1f pages/sec %6.2f MB/sec  peak RSS %d KB (workers %d KB)" % (
+                case["name"], case["pages_per_sec"], case["mb_per_sec"],
+                case["peak_rss_kb"], case["peak_rss_workers_kb"]))
+            print("  " + "  ".join("%s %.3fs" % item for item in case["stages"].items()))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Microbenchmarks of the converter's hot functions, on fixed inputs of growing size.
+#
+# For each benchmark the time is printed for every size, together with the scaling exponent
+# (time ~ size ** exponent, 1.0 is linear) so quadratic behavior shows up on small inputs already.
+#
+#   python3 blmw_to_rst_microbench.py
+#   python3 blmw_to_rst_microbench.py --check --output microbench.json
+
+import sys
+import io
+import json
+import math
+import time
+import contextlib
+import mwparserfromhell
+import blmw_to_rst
+
+# each benchmark runs at these multiples of its base size
+SIZE_FACTORS = (1, 2, 4, 8, 16)
+# best of this many runs is used
+REPEAT = 3
+# --check fails when the fitted exponent of a benchmark is above this
+MAX_EXPONENT = 1.4
+
+WORDS = (
+    "Scribus", "is", "a", "page", "layout", "program,", "text", "frames", "(and", "images)",
+    "are", "placed", "on", "the", "page.", "See", "[[Doc:Frames|frames]]", "for", "details;",
+    "styles:", "apply", "[[File:Style.png]]", "formatting]",
+)
+
+
+def words(n):
+    return " ".join(WORDS[i % len(WORDS)] for i in range(n))
+
+
+def input_paragraph(n):
+    # a single long line of body text, n words
+    return "Paragraph " + words(n)
+
+
+def input_plain_paragraph(n):
+    # a single long line of body text without punctuation, n words
+    return "Paragraph " + " ".join(WORDS[i % 16].strip(",.()") for i in range(n))
+
+
+def input_page(n):
+    # a page with n paragraphs, lists, definitions and tables (MediaWiki code)
+    lines = []
+    for i in range(n):
+        lines.append("== Section %d ==" % i)
+        lines.append(input_paragraph(40))
+        lines.append("* item ''%d'' -&gt; {{Literal|value}}" % i)
+        lines.append("** nested '''item''' `code`")
+        lines.append(";term %d : definition" % i)
+        lines.append("{|\n! a !! b\n|-\n| c || d\n|}")
+    return "\n".join(lines)
+
+
+def input_bullets(n):
+    # n bullet points nested up to 32 levels deep, as converted for postprocess()
+    italic = blmw_to_rst.remarkup("with markup", blmw_to_rst.M_ITALIC, None)
+    return "\n".join("%s item %d %s" % ("°" * (i % 32 + 1), i, italic) for i in range(n))
+
+
+def input_table(n):
+    # a table with 10 rows and n columns, as passed to rst_paint_table()
+    bold = blmw_to_rst.remarkup("bold", blmw_to_rst.M_BOLD, None)
+    return [["cell %d %d" % (row, col) if col % 3 else "┴%s  text" % bold for col in range(n)] for row in range(10)]
+
+
+def input_gallery(n):
+    # n image links with options and captions (MediaWiki code)
+    return "\n".join(
+        "[[File:Image_%d.png|thumb|left|%dpx|alt=Image %d|Caption with ''markup'' and [[Doc:Link|a link]]]]" %
+        (i, 100 + i % 400, i) for i in range(n))
+
+
+def input_nested(n):
+    # n groups of nested markup (MediaWiki code)
+    return " ".join(
+        "<b>bold %d <i>italic <code>code</code> ''text''</i> {{Literal|more <b>bold</b>}}</b>" % i
+        for i in range(n))
+
+
+def parse(mw):
+    return mwparserfromhell.parse(blmw_to_rst.preprocess(mw))
+
+
+def convert(mw):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return blmw_to_rst.convert_mw(parse(mw))[0]
+
+
+def paint_table(table, max_width, max_cells):
+    # rst_paint_table() with its size limits pinned, so every size takes the same path
+    limits = blmw_to_rst.TABLE_MAX_WIDTH, blmw_to_rst.TABLE_MAX_CELLS
+    blmw_to_rst.TABLE_MAX_WIDTH, blmw_to_rst.TABLE_MAX_CELLS = max_width, max_cells
+    try:
+        return blmw_to_rst.rst_paint_table([list(row) for row in table])
+    finally:
+        blmw_to_rst.TABLE_MAX_WIDTH, blmw_to_rst.TABLE_MAX_CELLS = limits
+
+
+# name -> (base size, create input, setup input, benchmarked function)
+# the setup isn't timed, its result is passed to the benchmarked function
+BENCHMARKS = {
+    "wrap_smart": (200, input_paragraph, None,
+                   lambda text: blmw_to_rst.wrap_smart(text, blmw_to_rst.WIDTH)),
+    "wrap_smart_plain": (200, input_plain_paragraph, None,
+                         lambda text: blmw_to_rst.wrap_smart(text, blmw_to_rst.WIDTH)),
+    "preprocess": (20, input_page, None, blmw_to_rst.preprocess),
+    "postprocess": (20, input_page, convert, blmw_to_rst.postprocess),
+    "postprocess_bullets": (200, input_bullets, None, blmw_to_rst.postprocess),
+    "rst_paint_table": (8, input_table, None,
+                        lambda table: paint_table(table, math.inf, math.inf)),
+    "rst_list_table": (8, input_table, None,
+                       lambda table: paint_table(table, 0, 0)),
+    "remarkup": (50, input_nested, parse, blmw_to_rst.convert_mw),
+    "wikilink_options": (50, input_gallery, parse, blmw_to_rst.convert_mw),
+}
+
+
+def time_best(fn, arg):
+    best = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(REPEAT):
+            t = time.perf_counter()
+            fn(arg)
+            t = time.perf_counter() - t
+            if best is None or t < best:
+                best = t
+    return best
+
+
+def fit_exponent(points):
+    # least squares slope in log-log space
+    xs = [math.log(size) for size, t in points]
+    ys = [math.log(max(t, 1e-9)) for size, t in points]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    return (sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) /
+            sum((x - x_mean) ** 2 for x in xs))
+
+
+def run_benchmark(name):
+    base, create, setup, fn = BENCHMARKS[name]
+    points = []
+    for factor in SIZE_FACTORS:
+        size = base * factor
+        arg = create(size)
+        if setup is not None:
+            arg = setup(arg)
+        points.append((size, time_best(fn, arg)))
+    return points
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the wiki to RST converter.")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all), one of: %s" %
+                        ", ".join(BENCHMARKS))
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--check", action="store_true",
+                        help="fail when a benchmark scales worse than size ** %s" % MAX_EXPONENT)
+    args = parser.parse_args()
+
+    results = {}
+    failed = []
+    for name in args.names or BENCHMARKS:
+        points = run_benchmark(name)
+        exponent = fit_exponent(points)
+        results[name] = {
+            "sizes": [size for size, t in points],
+            "seconds": [t for size, t in points],
+            "exponent": exponent,
+        }
+        print("%s: exponent %.2f" % (name, exponent))
+        size_prev = t_prev = None
+        for size, t in points:
+            if size_prev is None:
+                print("  %8d  %10.6fs" % (size, t))
+            else:
+                # the exponent between this size and the previous one
+                step = math.log(max(t, 1e-9) / max(t_prev, 1e-9)) / math.log(size / size_prev)
+                print("  %8d  %10.6fs  x%.2f" % (size, t, step))
+            size_prev, t_prev = size, t
+        if exponent > MAX_EXPONENT:
+            failed.append(name)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.check and failed:
+        print("SUPERLINEAR: %s" % ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,56 @@
 #!/usr/bin/env python3
 
-import xml.dom.minidom
+import xml.etree.ElementTree
 import blmw_to_rst
 import os
-import shutil
+import hashlib
+import pickle
+import json
+import functools
 
+WIKI_XML_PATH = 'migration/scribus_wiki.xml'
 MANUAL_PATH = 'migration/rst_manual'
 USE_MULTIPROCESS = True
+# number of worker processes, 0 for one per CPU
+JOB_TOTAL = 0
+# replace each worker after converting this many pages, None to keep workers for the whole run
+MAX_TASKS_PER_CHILD = None
+# pages are dispatched largest first, looking ahead this many pages in the dump,
+# 0 sorts the whole dump (keeping the text of every page in memory)
+SCHEDULE_WINDOW = 256
+
+# skip pages which have not changed since the last run,
+# (the page text and the converter are both checked)
+USE_CACHE = True
+CACHE_PATH = 'migration/convert_cache.pickle'
+# bump when the layout of the cache file changes
+CACHE_VERSION = 2
+
+# keep the parse trees of pages, so runs where only the converter changed don't parse again,
+# the least recently used trees are removed once the cache grows over AST_CACHE_SIZE (in bytes)
+USE_AST_CACHE = True
+AST_CACHE_PATH = 'migration/ast_cache'
+AST_CACHE_SIZE = 256 * 1024 * 1024
+
+# combined conversion report for all pages
+REPORT_PATH = 'migration/report.txt'
+# images embedded in the pages, read by rst_image_scrape.py
+IMAGES_PATH = 'migration/images.json'
+IMAGES_VERSION = 1
+
+# time each stage of the conversion of every page, written as one JSON object per line
+USE_TIMING = True
+TIMING_PATH = 'migration/timing.jsonl'
+# number of slowest pages to print once done
+TIMING_SLOWEST = 10
+# trace memory allocations (slows down the conversion), the peak of each stage of every page
+# is written as one JSON object per line, with the high-water mark of the process converting it
+USE_MEMORY = False
+MEMORY_PATH = 'migration/memory.jsonl'
+# number of most memory-hungry pages to print once done
+MEMORY_TOP = 10
+# write a cProfile of each process into this directory, None to disable, see blmw_to_rst.process_profile()
+PROFILE_PATH = None
 
 def rst_title(title, char, single=True):
     if single:
@@ -31,79 +75,154 @@ def rst_title(title, char, single=True):
 def create_conf():
     src = "../conf.py"
     dst = os.path.join(MANUAL_PATH, "conf.py")
-    shutil.copyfile(src, dst)
+    with open(src, encoding='utf-8') as f:
+        blmw_to_rst.write_if_changed(dst, f.read())
 
 
+# generated files are only written when their content changed, see blmw_to_rst.write_if_changed()
 def create_contents(paths, flat=False):
 
-    with open(os.path.join(MANUAL_PATH, "contents.rst"), 'w', encoding='utf-8') as f:
-        fw = f.write
+    f = []
+    fw = f.append
 
-        fw(rst_title("Scribus Manual contents", "%", single=False))
-        fw("\n\n")
-
-        fw(".. toctree::\n\n")
-
-        if flat:
-            for fn_full, fn in paths:
-                fw("   %s\n" % fn)
-        else:
-            paths_index = []
-            paths_other = []
-            for fn_full, fn in paths:
-                path_base = fn.split(os.sep)[0]
-                if path_base.endswith(".rst"):
-                    paths_other.append((fn_full, fn))
-                    continue
-                if path_base not in paths_index:
-                    fw("   %s/index.rst\n" % path_base)
-                    paths_index.append(path_base)
-            fw("\n\n")
+    fw(rst_title("Scribus Manual contents", "%", single=False))
+    fw("\n\n")
 
-            # these don't really fit, adding anyway
-            for fn_full, fn in paths_other:
-                    fw("   %s\n" % fn)
+    fw(".. toctree::\n\n")
 
+    if flat:
+        for fn_full, fn in paths:
+            fw("   %s\n" % fn)
+    else:
+        paths_index = []
+        paths_other = []
+        for fn_full, fn in paths:
+            path_base = fn.split(os.sep)[0]
+            if path_base.endswith(".rst"):
+                paths_other.append((fn_full, fn))
+                continue
+            if path_base not in paths_index:
+                fw("   %s/index.rst\n" % path_base)
+                paths_index.append(path_base)
+        fw("\n\n")
 
-            for path_base in paths_index:
-                with open(os.path.join(MANUAL_PATH, path_base, "index.rst"), 'w', encoding='utf-8') as fi:
-                    fiw = fi.write
-                    fiw(".. _%s-index:\n\n" % path_base)
+        # these don't really fit, adding anyway
+        for fn_full, fn in paths_other:
+                fw("   %s\n" % fn)
 
-                    fiw(rst_title(path_base.replace("_", "_").title(), "#", single=False))
-                    fiw("\n\n")
-                    fiw(".. toctree::\n\n")
-                    for fn_full, fn in paths:
-                        if fn.startswith(path_base + os.sep):
-                            fiw("   %s\n" % fn[len(path_base) + 1:])
 
+        for path_base in paths_index:
+            fi = []
+            fiw = fi.append
+            fiw(".. _%s-index:\n\n" % path_base)
 
-def main():
-    # Load the whole wiki manual xml export from MediaWiki
-    with open('migration/scribus_wiki.xml', encoding='utf-8') as f:
-        node = xml.dom.minidom.parse(f)
-
+            fiw(rst_title(path_base.replace("_", "_").title(), "#", single=False))
+            fiw("\n\n")
+            fiw(".. toctree::\n\n")
+            for fn_full, fn in paths:
+                if fn.startswith(path_base + os.sep):
+                    fiw("   %s\n" % fn[len(path_base) + 1:])
+            blmw_to_rst.write_if_changed(os.path.join(MANUAL_PATH, path_base, "index.rst"), "".join(fi))
+
+    blmw_to_rst.write_if_changed(os.path.join(MANUAL_PATH, "contents.rst"), "".join(f))
+
+
+def create_report(paths, pages):
+    # combine in page order, so the report doesn't depend on the order pages finished converting
+    report = blmw_to_rst.ConversionReport()
+    for fn_full, fn in paths:
+        report.merge(pages[fn_full][1])
+
+    with open(REPORT_PATH, 'w', encoding='utf-8') as f:
+        blmw_to_rst.print_report(report, f)
+
+
+def create_images(paths, pages):
+    # {image: [{"page": ..., "width": ..., "height": ...}, ...]} in page order
+    images = {}
+    for fn_full, fn in paths:
+        for image, width, height in pages[fn_full][1].images:
+            images.setdefault(image, []).append({"page": fn, "width": width, "height": height})
+    blmw_to_rst.write_if_changed(
+        IMAGES_PATH,
+        json.dumps({"version": IMAGES_VERSION, "images": images}, indent=1, sort_keys=True) + "\n")
+
+
+def wiki_pages(filepath):
+    """
+    Incrementally read a MediaWiki XML export, yielding (title, text) one page at a time.
+
+    Each page element is freed once it has been yielded,
+    so memory use does not grow with the size of the dump.
+    """
+    context = xml.etree.ElementTree.iterparse(filepath, events=('start', 'end'))
+    _, root = next(context)
+    # all elements share the export namespace, e.g: '{http://www.mediawiki.org/xml/export-0.8/}'
+    ns = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ""
+    tag_page = ns + 'page'
+    tag_title = ns + 'title'
+    tag_text = ns + 'text'
+
+    for event, elem in context:
+        if event != 'end' or elem.tag != tag_page:
+            continue
+        page_title = elem.findtext(tag_title)
+        page_text = None
+        for text in elem.iter(tag_text):
+            page_text = text.text
+        yield page_title, page_text or ""
+        # drop the page (and everything read before it) from the tree
+        elem.clear()
+        root.clear()
+
+
+def cache_load():
+    if not USE_CACHE:
+        return {}
+    try:
+        with open(CACHE_PATH, 'rb') as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache["pages"]
+
+
+def cache_save(pages):
+    if not USE_CACHE:
+        return
+    # write to a temporary file first, an interrupted run must not leave a broken cache
+    cache_path_tmp = CACHE_PATH + ".tmp"
+    with open(cache_path_tmp, 'wb') as f:
+        pickle.dump({"version": CACHE_VERSION, "pages": pages}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path_tmp, CACHE_PATH)
+
+
+def page_key(fingerprint, page_text):
+    h = hashlib.sha1(fingerprint.encode('utf-8'))
+    h.update(page_text.encode('utf-8'))
+    return h.hexdigest()
+
+
+def page_args(paths, cache, cache_next, pending):
     # Look into every 'page' node and build a page for it, saving it in a path
     # that mirrors the original MediaWiki path (and the title of the page)
-
-
-    # collect paths for re-use
-    paths = []
-    if USE_MULTIPROCESS:
-        args = []
-
-    for n in node.getElementsByTagName('page'):
-        for title in n.getElementsByTagName('title'):
-            page_title = title.firstChild.nodeValue
-            # Strip the "Help" namespace, make all lowercase
-            page_path = page_title[5:].lower()
-            # Remove whitespaces
-            page_path = page_path.replace(" ", "_")
-            # Remove "'"
-            page_path = page_path.replace("'", "")
-            print(page_path)
-        for text in n.getElementsByTagName('text'):
-            page_text = text.firstChild.nodeValue
+    #
+    # cache: (key, report) pairs from the previous run, unchanged pages are skipped.
+    # cache_next: (key, report) pairs of pages which are up to date.
+    # pending: keys of pages handed to the converter, moved into 'cache_next' once written.
+    fingerprint = blmw_to_rst.converter_fingerprint()
+    # output path -> title of the page written there
+    page_titles = {}
+    for page_title, page_text in wiki_pages(WIKI_XML_PATH):
+        # Strip the "Help" namespace, make all lowercase
+        page_path = page_title[5:].lower()
+        # Remove whitespaces
+        page_path = page_path.replace(" ", "_")
+        # Remove "'"
+        page_path = page_path.replace("'", "")
+        print(page_path)
 
         #if not "vitals/" in page_path:
         #    continue
@@ -116,22 +235,172 @@ def main():
         # We actually run the parser against the text tag content
         page_path_rst = page_path + ".rst"
         page_path_rst_full = os.path.join(MANUAL_PATH, page_path_rst)
-        arg = page_text, page_path_rst_full
-        if USE_MULTIPROCESS:
-            args.append(arg)
-        else:
-            blmw_to_rst.example_usage(*arg)
+        # titles differing only in case, spaces or "'" (or repeated in the dump)
+        # map to the same file, keep the first page
+        if page_path_rst_full in page_titles:
+            print("WARNING: page '%s' skipped, '%s' is already written to %s" %
+                  (page_title, page_titles[page_path_rst_full], page_path_rst_full))
+            continue
+        page_titles[page_path_rst_full] = page_title
         paths.append((page_path_rst_full, page_path_rst))
 
+        key = page_key(fingerprint, page_text)
+        entry = cache.get(page_path_rst_full)
+        if entry is not None and entry[0] == key and os.path.exists(page_path_rst_full):
+            cache_next[page_path_rst_full] = entry
+            continue
+        pending[page_path_rst_full] = key
+        yield page_text, page_path_rst_full
+
+
+def schedule_largest_first(args, window):
+    """
+    Reorder (page_text, output_file) pairs so the largest pages are converted first,
+    (longest-processing-time scheduling) so a huge page doesn't end up running alone at the end.
+
+    At most ``window`` pages are held back at once.
+    """
+    import heapq
+    heap = []
+    for i, arg in enumerate(args):
+        # the index keeps equally sized pages in dump order
+        heapq.heappush(heap, (-len(arg[0]), i, arg))
+        if window and len(heap) > window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def print_timing(timings):
+    """
+    Print the time spent in each stage and the slowest pages, from (page_path, timing) pairs.
+    """
+    stages = blmw_to_rst.STAGES
+    total = sum(timing[stage] for page_path, timing in timings for stage in stages)
+    if not total:
+        return
+    print("Time per stage (%d pages, %.2fs):" % (len(timings), total))
+    for stage in stages:
+        stage_total = sum(timing[stage] for page_path, timing in timings)
+        print("  %-12s %8.2fs %5.1f%%" % (stage, stage_total, stage_total * 100.0 / total))
+
+    print("Slowest pages:")
+    timings = sorted(timings, key=lambda item: sum(item[1][stage] for stage in stages), reverse=True)
+    for page_path, timing in timings[:TIMING_SLOWEST]:
+        stage, stage_time = max(((stage, timing[stage]) for stage in stages), key=lambda item: item[1])
+        print("  %8.3fs %s (%d chars, mostly %s %.3fs)" % (
+            sum(timing[stage] for stage in stages), page_path, timing["chars"], stage, stage_time))
+
+
+def print_memory(memories):
+    """
+    Print the high-water mark of the driver and each worker and the pages allocating the most,
+    from (page_path, memory) pairs.
+    """
+    import resource
+    mb = 1024.0 * 1024.0
+    print("Memory high-water mark:")
+    # kilobytes on Linux
+    print("  driver: %.1f MB traced, %.1f MB RSS" % (
+        blmw_to_rst.memory_peak() / mb,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    processes = {}
+    for page_path, memory in memories:
+        process = processes.setdefault(memory["pid"], [0, 0, 0])
+        process[0] = max(process[0], memory["process"])
+        process[1] = max(process[1], memory["process_rss_kb"])
+        process[2] += 1
+    pid_driver = os.getpid()
+    for pid, (peak, rss_kb, page_total) in sorted(processes.items()):
+        if pid != pid_driver:
+            print("  worker %d: %.1f MB traced, %.1f MB RSS (%d pages)" % (pid, peak / mb, rss_kb / 1024.0, page_total))
+
+    print("Most memory allocated by pages:")
+    stages = blmw_to_rst.STAGES
+    memories = sorted(memories, key=lambda item: item[1]["peak"], reverse=True)
+    for page_path, memory in memories[:MEMORY_TOP]:
+        stage = max(stages, key=lambda stage: memory[stage])
+        print("  %8.2f MB %s (mostly %s %.2f MB)" % (memory["peak"] / mb, page_path, stage, memory[stage] / mb))
+
+
+def main():
+    # Pages are read from the MediaWiki xml export one at a time,
+    # and handed to the converter as soon as they are read.
+
+    if USE_MEMORY:
+        # trace the driver too, the workers start tracing on their first page
+        blmw_to_rst.process_memory()
 
-    if USE_MULTIPROCESS:
-        import multiprocessing
-        job_total = multiprocessing.cpu_count()
-        pool = multiprocessing.Pool(processes=job_total * 2) 
-        pool.map(blmw_to_rst.example_usage_mp, args)
+    # collect paths for re-use
+    paths = []
+
+    cache = cache_load()
+    cache_next = {}
+    pending = {}
+    args = page_args(paths, cache, cache_next, pending)
+    convert_page = functools.partial(
+        blmw_to_rst.example_usage_mp,
+        ast_cache=AST_CACHE_PATH if USE_AST_CACHE else None,
+        timing=USE_TIMING,
+        memory=USE_MEMORY,
+        profile_dir=PROFILE_PATH,
+    )
+
+    timings = []
+    timing_file = open(TIMING_PATH, 'w', encoding='utf-8') if USE_TIMING else None
+    memories = []
+    memory_file = open(MEMORY_PATH, 'w', encoding='utf-8') if USE_MEMORY else None
+
+    def page_done(page_path_rst_full, report, timing, memory):
+        cache_next[page_path_rst_full] = pending.pop(page_path_rst_full), report
+        if timing is not None:
+            timings.append((page_path_rst_full, timing))
+            timing_file.write(json.dumps(dict(page=page_path_rst_full, **timing)) + "\n")
+        if memory is not None:
+            memories.append((page_path_rst_full, memory))
+            memory_file.write(json.dumps(dict(page=page_path_rst_full, **memory)) + "\n")
+
+    try:
+        if USE_MULTIPROCESS:
+            import multiprocessing
+            job_total = JOB_TOTAL or multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(processes=job_total, maxtasksperchild=MAX_TASKS_PER_CHILD)
+            try:
+                # one page per task, batching pages would undo the largest-first ordering
+                for result in pool.imap_unordered(
+                        convert_page,
+                        schedule_largest_first(args, SCHEDULE_WINDOW),
+                        chunksize=1,
+                ):
+                    page_done(*result)
+            except BaseException:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        else:
+            for arg in args:
+                page_done(*convert_page(arg))
+    finally:
+        if timing_file is not None:
+            timing_file.close()
+        if memory_file is not None:
+            memory_file.close()
+
+    cache_save(cache_next)
+    if USE_AST_CACHE:
+        blmw_to_rst.ast_cache_trim(AST_CACHE_PATH, AST_CACHE_SIZE)
 
     create_conf()
     create_contents(paths)
+    create_report(paths, cache_next)
+    create_images(paths, cache_next)
+    if timings:
+        print_timing(timings)
+    if USE_MEMORY:
+        print_memory(memories)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,60 @@
 #!/usr/bin/env python3
 
+# Download the images used by the converted pages (see IMAGES_PATH) from the wiki into OUT.
+# Images are only downloaded when missing or changed on the wiki, so executing a second time updates.
+#
+#   python3 rst_image_scrape.py
+#   python3 rst_image_scrape.py --url http://localhost:8000 --jobs 4
+
 import os
+import sys
+import json
+import hashlib
+import time
+import shutil
+import threading
+import http.client
+import urllib.parse
+
+CWD = "."
+# images embedded in the converted pages, written by blmw_to_rst_migrate.py
+# when missing, RST files in CWD are scanned for images instead
+IMAGES_PATH = "migration/images.json"
+IMAGES_VERSION = 1
+# the wiki to download from (may include a port)
+WIKI_URL = "http://wiki.scribus.net"
+# path of the MediaWiki API, relative to WIKI_URL
+API_PATH = "/api.php"
+# titles per imageinfo query, the API allows 50 (500 for bots)
+API_TITLES_MAX = 50
+OUT = "images"
+# downloaded images, their URL, size, hash and HTTP validators, see sync_load()
+SYNC_PATH = os.path.join(OUT, ".sync.json")
+SYNC_VERSION = 1
+# seconds an image is taken to be up to date after checking it with the wiki, 0 to always check
+SYNC_MAX_AGE = 24 * 60 * 60
+# the same image is often uploaded under several names, store each image once (by its hash)
+USE_DEDUP = True
+STORE_PATH = os.path.join(OUT, ".store")
+# names of duplicate images mapped to the one name used in the manual, read by conf.py
+ALIASES_PATH = os.path.join(OUT, ".aliases.json")
+
+# number of concurrent downloads
+JOB_TOTAL = 8
+# attempts for each request, the first retry waits RETRY_DELAY seconds, doubling for each following one
+RETRY_TOTAL = 4
+RETRY_DELAY = 1.0
+# HTTP status codes passed to handle_body(), besides 200 these answer conditional and range requests
+BODY_STATUS = {200, 206, 304, 416}
+# HTTP status codes worth retrying
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+REDIRECT_TOTAL = 5
+# seconds, for connecting and for each read
+TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+HEADERS = {"User-Agent": "scribus_manual rst_image_scrape.py"}
+
 
 def source_list(path, filename_check=None):
     for dirpath, dirnames, filenames in os.walk(path):
@@ -9,63 +63,551 @@ def source_list(path, filename_check=None):
             if filename_check is None or filename_check(filename):
                 yield os.path.join(dirpath, filename)
 
-import subprocess
-CWD = "."
-URL_PREFIX = "http://wiki.scribus.net/canvas/File:"
-OUT = "images"
 
-images = set()
-for f in source_list(CWD, filename_check=lambda f: f.endswith(".rst")):
-    print(f)
-    for l in open(f, encoding="utf-8"):
-        if " figure::" in l:
-            # maybe many figures in a table
-            for w in l.split("|"):
-                if " figure::" in w:
-                    image = w.split("::", 1)[1].strip()
-                    # remove: `/images/`
-                    image = image.split("/", 2)[2]
-                    image = image.strip("|+ ")
-                    images.add(image)
+def scan_images(path):
+    images = set()
+    for f in source_list(path, filename_check=lambda f: f.endswith(".rst")):
+        print(f)
+        for l in open(f, encoding="utf-8"):
+            if " figure::" in l:
+                # maybe many figures in a table
+                for w in l.split("|"):
+                    if " figure::" in w:
+                        image = w.split("::", 1)[1].strip()
+                        # remove: `/images/`
+                        image = image.split("/", 2)[2]
+                        image = image.strip("|+ ")
+                        images.add(image)
+    return images
 
-import urllib.parse
 
-os.system("mkdir " + OUT)
-for i, image in enumerate(sorted(images)):
+def load_images(path):
+    """
+    Returns the images listed in the manifest written by the migration, None when there is none.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    if manifest.get("version") != IMAGES_VERSION:
+        raise Exception("%s: unsupported version, run blmw_to_rst_migrate.py again" % path)
+    return set(manifest["images"])
 
-    image_final = os.path.join(OUT, image)
 
-    if os.path.exists(image_final):
-        #print("Found:", image)
-        continue
-    else:
-        print("Download:", image, "%d of %d" % (i + 1, len(images)))
-
-
-    URL = URL_PREFIX + urllib.parse.quote(image)
-    cmd = (
-        'wget',
-        URL,
-        '-O', 'tmp.html',
-        '--quiet',
-        )
-    #print("#", cmd)
-    subprocess.call(cmd)
-    URL_REAL = None
-    for h in open("tmp.html", encoding="utf-8"):
-        if "fullImageLink" in h:
-            URL_REAL = h.split('<a href="')[2].split('"', 1)[0]
-            break
-    if URL_REAL:
-        cmd = (
-            'wget',
-            "http://wiki.scribus.net" + URL_REAL,
-            '-O', image_final,
-            '--quiet'
-            )
-
-        #print(cmd)
-        subprocess.call(cmd)
+class FetchError(Exception):
+    pass
+
+
+# one keep-alive connection for each host, in every thread
+_local = threading.local()
+
+
+def connection(scheme, netloc):
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get((scheme, netloc))
+    if conn is None:
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=TIMEOUT)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=TIMEOUT)
+        connections[scheme, netloc] = conn
+    return conn
+
+
+def connection_close(scheme, netloc):
+    conn = _local.connections.pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+
+# duplicate images share their part file, one download writes it at a time
+_part_locks = {}
+_part_locks_lock = threading.Lock()
+
+
+def part_lock(path_part):
+    with _part_locks_lock:
+        return _part_locks.setdefault(path_part, threading.Lock())
+
+
+def request(url, handle_body, headers=None):
+    """
+    GET 'url', retrying failures with backoff.
+
+    headers: optional function returning extra request headers, called for each attempt
+       (so a resumed download continues where the previous attempt stopped).
+
+    Returns (location, result): the redirect location (or None),
+    and what handle_body(response) returned, None when the URL doesn't exist.
+    """
+    parts = urllib.parse.urlsplit(url)
+    target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+    delay = RETRY_DELAY
+    attempt = 0
+    while True:
+        conn = connection(parts.scheme, parts.netloc)
+        # the server may have closed an idle connection, which doesn't count as an attempt
+        reused = conn.sock is not None
+        try:
+            conn.request("GET", target, headers=dict(HEADERS, **headers()) if headers else HEADERS)
+            response = conn.getresponse()
+            if response.status in BODY_STATUS:
+                return None, handle_body(response)
+            # read the whole response, so the connection can be reused
+            response.read()
+            if response.status in REDIRECT_STATUS:
+                return response.getheader("Location", ""), None
+            if response.status in {404, 410}:
+                return None, None
+            error = "HTTP %d %s" % (response.status, response.reason)
+            if response.status not in RETRY_STATUS:
+                raise FetchError("%s: %s" % (url, error))
+        except (OSError, http.client.HTTPException) as ex:
+            # the connection may be in any state, start over with a new one
+            connection_close(parts.scheme, parts.netloc)
+            error = "%s %s" % (type(ex).__name__, ex)
+            if reused:
+                continue
+        attempt += 1
+        if attempt == RETRY_TOTAL:
+            raise FetchError("%s: %s (%d attempts)" % (url, error, attempt))
+        time.sleep(delay)
+        delay *= 2
+
+
+def fetch(url, handle_body, headers=None):
+    """
+    GET 'url' following redirects, returns the result of handle_body(response)
+    or None when the URL doesn't exist, see request().
+    """
+    for i in range(REDIRECT_TOTAL + 1):
+        location, result = request(url, handle_body, headers)
+        if location is None:
+            return result
+        url = urllib.parse.urljoin(url, location)
+    raise FetchError("%s: too many redirects" % url)
+
+
+def read_json(response):
+    return json.loads(response.read().decode("utf-8"))
+
+
+def file_sha1(path):
+    # returns None when the file doesn't exist
+    h = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(CHUNK_SIZE), b""):
+                h.update(data)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def sync_load():
+    """
+    Returns {image: entry} for images downloaded by previous runs, each entry holds
+    the 'url', 'size', 'sha1', 'etag' and 'last_modified' of the download
+    and when the image was 'checked' with the wiki last.
+    """
+    try:
+        with open(SYNC_PATH, encoding="utf-8") as f:
+            sync = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if sync.get("version") != SYNC_VERSION:
+        return {}
+    return sync["images"]
+
+
+def sync_save(images):
+    # write to a temporary file first, an interrupted run must not leave a broken manifest
+    sync_path_tmp = SYNC_PATH + ".tmp"
+    with open(sync_path_tmp, 'w', encoding="utf-8") as f:
+        json.dump({"version": SYNC_VERSION, "images": images}, f, indent=1, sort_keys=True)
+    os.replace(sync_path_tmp, SYNC_PATH)
+
+
+def resolve_batch(images, api_url):
+    """
+    Query the imageinfo of up to API_TITLES_MAX images at once,
+    returns {image: imageinfo}, where imageinfo has the 'url', 'size' and 'sha1' of the image
+    (None for images that don't exist).
+    """
+    query = urllib.parse.urlencode({
+        "action": "query",
+        "prop": "imageinfo",
+        "iiprop": "url|size|sha1",
+        "titles": "|".join("File:" + image for image in images),
+        "redirects": "1",
+        "format": "json",
+        "formatversion": "2",
+    })
+    result = fetch(api_url + "?" + query, read_json)
+    if result is None:
+        raise FetchError("%s: API not found" % api_url)
+    if "error" in result:
+        raise FetchError("%s: %s" % (api_url, result["error"].get("info", result["error"])))
+    result = result.get("query", {})
+
+    # the API answers with the title it normalized (and redirected) each requested title to
+    titles = {}
+    for key in ("normalized", "redirects"):
+        for item in result.get(key, ()):
+            titles[item["from"]] = item["to"]
+    pages = {}
+    for page in result.get("pages", ()):
+        imageinfo = page.get("imageinfo")
+        pages[page["title"]] = imageinfo[0] if imageinfo else None
+
+    info = {}
+    for image in images:
+        title = "File:" + image
+        # follow normalization, then a redirect
+        for i in range(2):
+            title = titles.get(title, title)
+        info[image] = pages.get(title)
+    return info
+
+
+def resolve_images(images, wiki_url, executor):
+    """
+    Look up the imageinfo of all images (API_TITLES_MAX per request), see resolve_batch().
+    """
+    images = sorted(images)
+    api_url = wiki_url + API_PATH
+    batches = [images[i:i + API_TITLES_MAX] for i in range(0, len(images), API_TITLES_MAX)]
+    info = {}
+    for info_batch in executor.map(lambda batch: resolve_batch(batch, api_url), batches):
+        info.update(info_batch)
+    return info
+
+
+def download_image(image, imageinfo, entry):
+    """
+    Download 'image' into OUT, verifying its size and hash.
+
+    entry: the manifest entry of the intact local copy of the image (or None),
+       when the wiki doesn't report a hash, its validators make the request conditional.
+
+    Returns (modified, entry) with the new manifest entry of the image.
+
+    The image is written to a part file named after its hash,
+    so an interrupted download is resumed by the next attempt (or run),
+    downloads of images with the same hash take turns using it.
+    """
+    path = os.path.join(OUT, image)
+    url = imageinfo["url"]
+    size = imageinfo.get("size")
+    sha1 = imageinfo.get("sha1")
+    # without a hash a part file can't be matched to the version of the image on the wiki
+    resume = sha1 is not None
+    path_part = os.path.join(OUT, ".%s.part" % (sha1 if resume else image))
+    if not resume and os.path.exists(path_part):
+        os.remove(path_part)
+
+    conditional = {}
+    if entry is not None and entry["url"] == url and not resume:
+        if entry.get("etag"):
+            conditional["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            conditional["If-Modified-Since"] = entry["last_modified"]
+
+    def headers():
+        offset = os.path.getsize(path_part) if resume and os.path.exists(path_part) else 0
+        if offset:
+            return {"Range": "bytes=%d-" % offset}
+        return conditional
+
+    def handle_body(response):
+        if response.status == 304:
+            response.read()
+            return False
+        if response.status == 416:
+            # the part file doesn't fit the image, start over
+            response.read()
+            os.remove(path_part)
+            raise http.client.HTTPException("range not satisfiable")
+        h = hashlib.sha1()
+        mode = 'wb'
+        if response.status == 206:
+            offset = os.path.getsize(path_part)
+            if not response.getheader("Content-Range", "").startswith("bytes %d-" % offset):
+                os.remove(path_part)
+                raise http.client.HTTPException("unexpected range: %s" % response.getheader("Content-Range"))
+            with open(path_part, 'rb') as f:
+                for data in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    h.update(data)
+            mode = 'ab'
+        length = response.getheader("Content-Length")
+        with open(path_part, mode) as f:
+            start = f.tell()
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+                f.write(data)
+            # a truncated download is kept, the next attempt continues it
+            if length is not None and f.tell() - start != int(length):
+                raise http.client.IncompleteRead(b"", int(length) - (f.tell() - start))
+            written = f.tell()
+        if (size is not None and written != size) or (sha1 is not None and h.hexdigest() != sha1):
+            os.remove(path_part)
+            raise http.client.HTTPException("size or SHA-1 mismatch")
+        # only rename into place once complete
+        os.replace(path_part, path)
+        return {
+            "url": url,
+            "size": written,
+            "sha1": h.hexdigest(),
+            "etag": response.getheader("ETag"),
+            "last_modified": response.getheader("Last-Modified"),
+        }
+
+    with part_lock(path_part):
+        result = fetch(url, handle_body, headers)
+    if result is None:
+        raise FetchError("%s: not found" % url)
+    if result is False:
+        return False, dict(entry)
+    return True, result
+
+
+def source_path(image, source_dir):
+    """
+    Returns the path of 'image' in a copy of a wiki's images directory,
+    which MediaWiki splits into directories by the md5 of the file name: 'a/ab/Name.png'.
+    """
+    # the name as MediaWiki stores it: underscores, first letter upper case
+    name = image.replace(" ", "_")
+    name = name[:1].upper() + name[1:]
+    h = hashlib.md5(name.encode("utf-8")).hexdigest()
+    return os.path.join(source_dir, h[0], h[:2], name)
+
+
+def copy_image(image, path_source, sha1_local, link=False):
+    """
+    Copy (or hard-link) 'image' into OUT from 'path_source',
+    returns the new manifest entry of the image, None when the local copy is already the same.
+    """
+    path = os.path.join(OUT, image)
+    sha1 = file_sha1(path_source)
+    if sha1 is None:
+        raise FileNotFoundError(path_source)
+    # a linked image may be linked to an identical image stored under another name, see dedup_images()
+    if sha1 == sha1_local and (not link or os.stat(path).st_nlink > 1):
+        return None
+    path_tmp = os.path.join(OUT, ".%s.%d.tmp" % (image, os.getpid()))
+    try:
+        if link:
+            os.link(path_source, path_tmp)
+        else:
+            shutil.copyfile(path_source, path_tmp)
+        os.replace(path_tmp, path)
+    except BaseException:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+        raise
+    return {"url": os.path.abspath(path_source), "size": os.path.getsize(path), "sha1": sha1}
+
+
+def sync_copy(images, local, sync, now, source_dir, link=False):
+    """
+    Copy images from a copy of the wiki's images directory, see copy_image().
+    """
+    # a local operation, all images are checked
+    for image in sorted(images):
+        path_source = source_path(image, source_dir)
+        try:
+            entry = copy_image(image, path_source, local[image], link)
+        except FileNotFoundError:
+            print("IMAGE NOT FOUND", image, path_source)
+            continue
+        if entry is None:
+            entry = sync.get(image)
+            if entry is None or entry["sha1"] != local[image]:
+                entry = {"url": os.path.abspath(path_source), "size": os.path.getsize(path_source), "sha1": local[image]}
+        else:
+            print("Copy:", image)
+        entry["checked"] = now
+        sync[image] = entry
+    sync_save(sync)
+
+
+def sync_download(images, local, sync, now, wiki_url, max_age, jobs):
+    """
+    Download images which are missing or changed on the wiki, returns the images that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    # the manifest entry of images which are intact
+    intact = {}
+    images_todo = []
+    for image in sorted(images):
+        entry = sync.get(image)
+        if entry is not None and local[image] is not None and entry["sha1"] == local[image]:
+            intact[image] = entry
+            if now - entry["checked"] < max_age:
+                continue
+        images_todo.append(image)
+    print("%d of %d images up to date, checking %d" % (len(images) - len(images_todo), len(images), len(images_todo)))
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        info = resolve_images(images_todo, wiki_url, executor) if images_todo else {}
+        futures = {}
+        for image in images_todo:
+            imageinfo = info[image]
+            if imageinfo is None:
+                print("IMAGE NOT FOUND", image)
+            elif imageinfo.get("sha1") is not None and imageinfo["sha1"] == local[image]:
+                # unchanged on the wiki, no need to download
+                sync[image] = dict(intact.get(image, {}), url=imageinfo["url"], size=imageinfo["size"], sha1=local[image])
+                sync[image]["checked"] = now
+            else:
+                futures[executor.submit(download_image, image, imageinfo, intact.get(image))] = image
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                image = futures[future]
+                try:
+                    modified, entry = future.result()
+                except FetchError as ex:
+                    print("DOWNLOAD FAILED", image, ex)
+                    failed.append(image)
+                    continue
+                entry["checked"] = now
+                sync[image] = entry
+                print("Download:" if modified else "Unchanged:", image, "%d of %d" % (i + 1, len(futures)))
+        finally:
+            sync_save(sync)
+
+    # part files are only kept to resume failed downloads
+    parts_keep = {".%s.part" % info[image]["sha1"] for image in failed if info[image].get("sha1")}
+    for filename in os.listdir(OUT):
+        if filename.endswith(".part") and filename not in parts_keep:
+            os.remove(os.path.join(OUT, filename))
+    return failed
+
+
+def link_replace(path_source, path):
+    # hard-link 'path' to 'path_source', replacing 'path' atomically
+    path_tmp = "%s.%d.tmp" % (path, os.getpid())
+    os.link(path_source, path_tmp)
+    try:
+        os.replace(path_tmp, path)
+    except BaseException:
+        os.remove(path_tmp)
+        raise
+
+
+def dedup_images(images, sync, now, local):
+    """
+    Store images by their content in STORE_PATH, hard-linking each name to its stored copy,
+    and write a table mapping the names of duplicate images to one name (ALIASES_PATH),
+    used when building the manual so each image is copied into the output once.
+    """
+    # the hash of every image, where the manifest is known to match the file
+    hashes = {}
+    for image in images:
+        entry = sync.get(image)
+        if entry is not None and (entry["checked"] == now or entry["sha1"] == local[image]):
+            hashes[image] = entry["sha1"]
+
+    os.makedirs(STORE_PATH, exist_ok=True)
+    names = {}
+    # stored images known to hold their content
+    verified = set()
+    linked = True
+    for image, sha1 in sorted(hashes.items()):
+        path = os.path.join(OUT, image)
+        path_store = os.path.join(STORE_PATH, sha1 + os.path.splitext(image)[1].lower())
+        names.setdefault(sha1, []).append(image)
+        if not linked:
+            continue
+        try:
+            if path_store not in verified:
+                # writing to any of its names changes the stored image,
+                # replace it with this copy (which matches the manifest)
+                if file_sha1(path_store) != sha1:
+                    link_replace(path, path_store)
+                verified.add(path_store)
+            if not os.path.samefile(path_store, path):
+                link_replace(path_store, path)
+        except OSError as ex:
+            # hard-links aren't supported everywhere, duplicates are still aliased
+            print("Not storing images by content:", ex)
+            linked = False
+
+    # stored images no longer used
+    sha1_used = set(names)
+    for filename in os.listdir(STORE_PATH):
+        if os.path.splitext(filename)[0] not in sha1_used:
+            os.remove(os.path.join(STORE_PATH, filename))
+
+    aliases = {}
+    size_total = size_saved = 0
+    for sha1, images_same in names.items():
+        size = os.path.getsize(os.path.join(OUT, images_same[0]))
+        size_total += size * len(images_same)
+        size_saved += size * (len(images_same) - 1)
+        for image in images_same[1:]:
+            aliases[image] = images_same[0]
+
+    aliases_tmp = ALIASES_PATH + ".tmp"
+    with open(aliases_tmp, 'w', encoding="utf-8") as f:
+        json.dump(aliases, f, indent=1, sort_keys=True)
+    os.replace(aliases_tmp, ALIASES_PATH)
+
+    mb = 1024.0 * 1024.0
+    print("%d images, %d distinct, %d duplicates: %.2f MB of %.2f MB saved (%.1f%%)" % (
+        len(hashes), len(names), len(aliases), size_saved / mb, size_total / mb,
+        (size_saved * 100.0 / size_total) if size_total else 0.0))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Download the images used by the RST files from the wiki.")
+    parser.add_argument("--url", default=WIKI_URL, help="the wiki to download from (default: %(default)s)")
+    parser.add_argument("--jobs", type=int, default=JOB_TOTAL,
+                        help="number of concurrent downloads (default: %(default)s)")
+    parser.add_argument("--images", default=IMAGES_PATH,
+                        help="the images manifest written by the migration (default: %(default)s)")
+    parser.add_argument("--refresh", action="store_true",
+                        help="check all images with the wiki, even those checked recently")
+    parser.add_argument("--source",
+                        help="copy images from this copy of the wiki's images directory instead of downloading")
+    parser.add_argument("--link", action="store_true",
+                        help="with --source, hard-link images instead of copying them")
+    args = parser.parse_args()
+    wiki_url = args.url.rstrip("/")
+
+    images = load_images(args.images)
+    if images is None:
+        print("No %s, scanning RST files" % args.images)
+        images = scan_images(CWD)
+
+    os.makedirs(OUT, exist_ok=True)
+    sync = sync_load()
+    now = time.time()
+    max_age = 0 if args.refresh else SYNC_MAX_AGE
+    # the hash of the local copy of each image (None when missing)
+    local = {image: file_sha1(os.path.join(OUT, image)) for image in images}
+
+    failed = []
+    if args.source:
+        sync_copy(images, local, sync, now, args.source, args.link)
     else:
-        print("IMAGE NOT FOUND", image)
+        failed = sync_download(images, local, sync, now, wiki_url, max_age, args.jobs)
+
+    if USE_DEDUP:
+        dedup_images(images, sync, now, local)
+
+    if failed:
+        sys.exit(1)
+
 
+if __name__ == "__main__":
+    main()
@@ -253,3 +253,30 @@ texinfo_documents = [
 # How to display URL addresses: 'footnote', 'no', or 'inline'.
 #texinfo_show_urls = 'footnote'
 
+
+
+# -- Duplicate images ----------------------------------------------------------
+
+# The same image is often uploaded to the wiki under several names,
+# _tools/rst_image_scrape.py maps these names to one of them (in images/.aliases.json),
+# so each image is copied into the output once.
+
+def image_aliases_apply(app, doctree):
+    from docutils import nodes
+    aliases = app.config.image_aliases
+    for node in getattr(doctree, 'findall', doctree.traverse)(nodes.image):
+        head, sep, name = node['uri'].rpartition('/')
+        if name in aliases:
+            node['uri'] = head + sep + aliases[name]
+
+
+def setup(app):
+    import json
+    try:
+        with open(os.path.join(app.srcdir, 'images', '.aliases.json'), encoding='utf-8') as f:
+            aliases = json.load(f)
+    except (OSError, ValueError):
+        aliases = {}
+    app.add_config_value('image_aliases', aliases, 'env')
+    # before Sphinx collects the images of each document (at the default priority of 500)
+    app.connect('doctree-read', image_aliases_apply, priority=400)